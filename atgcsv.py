@@ -10,17 +10,51 @@ Part of KaiSD Text Tools
 
 License: GPLv3
 '''
-from sys import argv
-from os.path import split
-from att import ATG, CSVData, TemplateV2
+from optparse import OptionParser
+from att import ATG, CSVData, CSVStreamData, TemplateV2, TarSink, ZipSink
+
+def open_sink(path):
+    '''
+    Returns the archive sink for the output path, if it is an archive name.
+    '''
+    lower = path.lower()
+    if lower.endswith('.zip'):
+        return ZipSink(path)
+    elif lower.endswith('.tar.gz') or lower.endswith('.tgz'):
+        return TarSink(path, 'w:gz')
+    elif lower.endswith('.tar.bz2'):
+        return TarSink(path, 'w:bz2')
+    elif lower.endswith('.tar'):
+        return TarSink(path)
+    return None
 
 if __name__ == '__main__':
-    if len(argv) == 3:
-        generator = ATG(CSVData(argv[1]), TemplateV2(argv[2]))
-        generator.write_files()
-    elif len(argv) == 4:
-        generator = ATG(CSVData(argv[1]), TemplateV2(argv[2]))
-        generator.write_files(argv[3])
+    parser = OptionParser(usage='%prog [options] <CSV file> <Template file> [Output directory or .tar/.tar.gz/.zip file]',
+                          epilog='(c)2015 Ivan "Kai SD" Korystin')
+    parser.add_option('--cache', action='store_true', default=False,
+                      help='keep the parsed table in a binary snapshot (<CSV file>.snapshot) and load it from there, while the CSV file is not changed')
+    parser.add_option('--manifest', action='store_true', default=False,
+                      help='keep content hashes of the files in .atgmanifest in the output directory and do not write files, which have not been changed')
+    parser.add_option('--clean', action='store_true', default=False,
+                      help='remove files from the previous run, which are not generated any more (implies --manifest)')
+    options, args = parser.parse_args()
+    
+    if len(args) in (2, 3):
+        if options.cache:
+            data = CSVData(args[0], cache=True)
+        else:
+            data = CSVStreamData(args[0])
+        generator = ATG(data, TemplateV2(args[1]), stream=True)
+        sink = None
+        if len(args) == 3:
+            sink = open_sink(args[2])
+        if sink is None:
+            generator.write_files(args[2] if len(args) == 3 else '.',
+                                  manifest=options.manifest or options.clean, clean=options.clean)
+        else:
+            with sink:
+                generator.write_files(sink)
+        print generator.summary()
+        print generator.throughput()
     else:
-        print 'Usage:', split(argv[0])[-1], '<CSV file>', '<Template file>', '[Output directory]'
-        print '(c)2015 Ivan "Kai SD" Korystin' 
+        parser.print_help()
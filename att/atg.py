@@ -7,28 +7,558 @@ Automatic Text Generator module for a Automatic Text Tools.
 
 License: GPLv3
 '''
-from os.path import join, exists
-from os import makedirs
+from os.path import join, exists, relpath, dirname, abspath, split
+from os import makedirs, remove, rename, fdopen, stat, listdir, chmod, umask
+from shutil import copyfile
+from cStringIO import StringIO
+import codecs, tempfile, threading, Queue, sys, hashlib, marshal, tarfile, zipfile, time, inspect
+
+STATE_MAGIC = 'ATGSTATE1'
+
+def _reset_mode(fname):
+    '''
+    Gives the file, created by mkstemp (readable by the owner only),
+    the mode, open() would give it.
+    '''
+    mask = umask(0)
+    umask(mask)
+    chmod(fname, 0666 & ~mask)
+
+class ChunkWriter(object):
+    '''
+    Encodes the text incrementally and writes it to the file in large chunks.
+    '''
+    def __init__(self, f, encoding, size=65536):
+        '''
+        Constructor.
+        f - an open file
+        encoding - output encoding
+        size - number of characters to collect before writing
+        '''
+        self.file = f
+        self.encoder = codecs.getincrementalencoder(encoding)()
+        self.size = size
+        self.chunks = []
+        self.length = 0
+        self.busy = 0.0
+    
+    def write(self, text):
+        '''
+        Adds the text to the output.
+        '''
+        self.chunks.append(text)
+        self.length += len(text)
+        if self.length >= self.size:
+            self.flush()
+    
+    def flush(self, final=False):
+        '''
+        Writes collected text to the file.
+        '''
+        start = time.time()
+        self.file.write(self.encoder.encode(u''.join(self.chunks), final))
+        self.busy += time.time() - start
+        self.chunks = []
+        self.length = 0
+    
+    def close(self):
+        '''
+        Writes the rest of the text. The file is not closed.
+        '''
+        self.flush(True)
+
+class WriterPool(object):
+    '''
+    Pool of threads, calling the function for the queued arguments.
+    Calls with the same first argument (i.e. the file name) are made by
+    the same thread in the order they were queued, so the last one wins.
+    Calls are queued in batches. Queues of the threads are bounded, so put()
+    waits while the thread is busy.
+    After close(), busy and idle are the total time the threads have
+    spent in the calls and waiting for them, stalled - the time put() has
+    waited for the threads.
+    '''
+    def __init__(self, function, threads=4, batch=64, size=None):
+        '''
+        Constructor.
+        function - function to call
+        threads - number of threads
+        batch - number of calls, passed to a thread at once
+        size - maximal number of queued batches per thread (default: 2)
+        '''
+        self.function = function
+        self.batchSize = batch
+        self.batches = [[] for i in xrange(threads)]
+        self.queues = [Queue.Queue(size or 2) for i in xrange(threads)]
+        self.error = None
+        self.lock = threading.Lock()
+        self.busy = 0.0
+        self.idle = 0.0
+        self.stalled = 0.0
+        self.threads = []
+        for queue in self.queues:
+            thread = threading.Thread(target=self.run, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+    
+    def run(self, queue):
+        function = self.function
+        busy = 0.0
+        idle = 0.0
+        while True:
+            start = time.time()
+            batch = queue.get()
+            idle += time.time() - start
+            if batch is None:
+                break
+            if self.error is None:
+                start = time.time()
+                try:
+                    for args in batch:
+                        function(*args)
+                except:
+                    self.error = sys.exc_info()
+                busy += time.time() - start
+        with self.lock:
+            self.busy += busy
+            self.idle += idle
+    
+    def put(self, *args):
+        '''
+        Queues the call of the function with given arguments. Raises
+        the exception of a failed call, if there was one.
+        '''
+        if not self.error is None:
+            self.close()
+        i = hash(args[0]) % len(self.queues)
+        batch = self.batches[i]
+        batch.append(args)
+        if len(batch) >= self.batchSize:
+            start = time.time()
+            self.queues[i].put(batch)
+            self.stalled += time.time() - start
+            self.batches[i] = []
+    
+    def close(self):
+        '''
+        Waits for all the queued calls and stops the threads. Raises
+        the exception of a failed call, if there was one.
+        '''
+        for i in xrange(len(self.batches)):
+            if self.batches[i] and self.error is None and self.threads:
+                self.queues[i].put(self.batches[i])
+            self.batches[i] = []
+        threads = self.threads
+        self.threads = []
+        for queue in self.queues[:len(threads)]:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+        if not self.error is None:
+            error = self.error
+            self.error = None
+            raise error[0], error[1], error[2]
+
+class Manifest(object):
+    '''
+    Content hashes of the files, written by ATG, by their paths relative to
+    the output directory. The size and modification time of each file are
+    kept too, so files, changed by someone else, are written again.
+    '''
+    MAGIC = 'ATGMANIFEST1'
+    
+    def __init__(self, filename, outputDir):
+        '''
+        Constructor.
+        filename - manifest file name
+        outputDir - directory of the files
+        '''
+        self.filename = filename
+        self.outputDir = unicode(outputDir)
+        self.entries = {}
+        self.produced = {}
+        self.load()
+    
+    def load(self):
+        '''
+        Reads the entries of the previous run, if there are any.
+        '''
+        if not exists(self.filename):
+            return
+        with open(self.filename, 'rb') as f:
+            if not f.readline().rstrip('\n') == self.MAGIC:
+                return
+            for line in f:
+                digest, size, mtime, path = line.rstrip('\n').split('\t', 3)
+                self.entries[path.decode('utf-8')] = (digest, int(size), mtime)
+    
+    def save(self):
+        '''
+        Writes the entries of the files, produced by this run.
+        '''
+        handle, tmpname = tempfile.mkstemp('.tmp', 'atg', dirname(self.filename) or '.')
+        with fdopen(handle, 'wb') as f:
+            f.write(self.MAGIC + '\n')
+            for path in sorted(self.produced):
+                digest, size, mtime = self.produced[path]
+                f.write('%s\t%i\t%s\t%s\n' % (digest, size, mtime, path.encode('utf-8')))
+        if exists(self.filename):
+            remove(self.filename)
+        rename(tmpname, self.filename)
+        _reset_mode(self.filename)
+    
+    def path(self, fname):
+        return relpath(fname, self.outputDir)
+    
+    def unchanged(self, fname, digest):
+        '''
+        Returns True if the file has been written by the previous run with
+        the same content and has not been changed since.
+        '''
+        path = self.path(fname)
+        entry = self.entries.get(path)
+        if entry is None or not entry[0] == digest:
+            return False
+        try:
+            st = stat(fname)
+        except OSError:
+            return False
+        if st.st_size == entry[1] and repr(st.st_mtime) == entry[2]:
+            self.produced[path] = entry
+            return True
+        return False
+    
+    def update(self, fname, digest):
+        '''
+        Adds the entry for the written file.
+        '''
+        st = stat(fname)
+        self.produced[self.path(fname)] = (digest, st.st_size, repr(st.st_mtime))
+    
+    def keep(self, fname):
+        '''
+        Keeps the entry of the file from the previous run, which has not
+        been written by this one.
+        '''
+        path = self.path(fname)
+        if path in self.entries:
+            self.produced[path] = self.entries[path]
+    
+    def stale(self):
+        '''
+        Returns the paths of the files from the previous run, which were
+        not produced by this one.
+        '''
+        return [path for path in self.entries if not path in self.produced]
+
+class RowSelector(object):
+    '''
+    Selects the rows to generate in the incremental mode of ATG. Every row
+    is identified by the hash of its values and of the values of the rows
+    around it, used by ATGPREV and ATGNEXT. Rows with the same hash as in
+    the previous run are not generated, if their file still exists.
+    Rows with a key, that has been met before, are always generated, so
+    the file of a repeated key gets the text of the last row.
+    '''
+    MISSING = '\x00' * 16
+    
+    def __init__(self, digest, old, keyIndex, behind=0, ahead=0, check=None):
+        '''
+        Constructor.
+        digest - hash of the template and the data columns
+        old - dictionary of (hash, name) by keys from the previous run
+        keyIndex - index of the key column
+        behind, ahead - number of rows before and after the row, used by it
+        check - function, returning True if the file with given name exists
+        '''
+        self.digest = digest
+        self.old = old
+        self.new = {}
+        self.keyIndex = keyIndex
+        self.behind = behind
+        self.ahead = ahead
+        self.check = check
+        self.hashes = {}
+        self.keys = {}
+        self.count = 0
+        self.kept = []
+    
+    def feed(self, rows):
+        '''
+        Yields the rows, remembering their hashes.
+        '''
+        keyIndex = self.keyIndex
+        hashes = self.hashes
+        keys = self.keys
+        md5 = hashlib.md5
+        for row in rows:
+            hashes[self.count] = md5(u'\x00'.join(map(unicode, row)).encode('utf-8')).digest()
+            keys[self.count] = row[keyIndex]
+            self.count += 1
+            yield row
+    
+    def selected(self, index):
+        '''
+        Returns True if the row with given index should be generated.
+        Should be called for every row in order, after the rows, used by it,
+        have been read.
+        '''
+        hashes = self.hashes
+        if self.behind or self.ahead:
+            digest = hashlib.md5()
+            for i in xrange(index - self.behind, index + self.ahead + 1):
+                digest.update(hashes.get(i, self.MISSING))
+            digest = digest.digest()
+        else:
+            digest = hashes[index]
+        hashes.pop(index - self.behind, None)
+        key = self.keys.pop(index)
+        if key in self.new:
+            # the file is not made by the first row, so it is not kept next time
+            self.new[key] = (None, self.new[key][1])
+            return True
+        
+        old = self.old.get(key)
+        if not old is None and old[0] == digest:
+            name = old[1]
+            if name is None or self.check is None or self.check(name):
+                self.new[key] = old
+                if not name is None:
+                    self.kept.append(name)
+                return False
+        self.new[key] = (digest, None)
+        return True
+    
+    def named(self, key, name):
+        '''
+        Sets the file name for the generated row with given key.
+        '''
+        self.new[key] = (self.new[key][0], name)
+
+class Sink(object):
+    '''
+    Output of the generated files. Replace write, write_path and close
+    in subclasses.
+    Sinks can be used in the with statement, to be closed at the end:
+    with TarSink('out.tar.gz', 'w:gz') as sink:
+        ATG(data, template).write_files(sink)
+    '''
+    def write(self, name, data):
+        '''
+        Writes the file.
+        name - file name with '/' separators
+        data - encoded file content
+        '''
+        pass
+    
+    def write_path(self, name, filename):
+        '''
+        Writes the file with the content of the local file.
+        '''
+        with open(filename, 'rb') as f:
+            self.write(name, f.read())
+    
+    def close(self):
+        '''
+        Finishes the output.
+        '''
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+class DirectorySink(Sink):
+    '''
+    Writes the files to the directory. ATG.write_files writes to
+    the directory of this sink as to the plain directory name.
+    '''
+    def __init__(self, path='.'):
+        self.path = path
+        self.dirs = set()
+    
+    def target(self, name):
+        path = join(unicode(self.path), *name.split('/'))
+        folder = dirname(path)
+        if not folder in self.dirs:
+            if folder and not exists(folder):
+                makedirs(folder)
+            self.dirs.add(folder)
+        return path
+    
+    def write(self, name, data):
+        with open(self.target(name), 'wb') as f:
+            f.write(data)
+    
+    def write_path(self, name, filename):
+        copyfile(filename, self.target(name))
+
+class TarSink(Sink):
+    '''
+    Writes the files to the tar archive as they are generated.
+    '''
+    def __init__(self, file, mode='w'):
+        '''
+        Constructor.
+        file - archive file name or an open file
+        mode - tarfile mode: 'w', 'w:gz' or 'w:bz2' (default: w)
+        '''
+        if isinstance(file, basestring):
+            self.tar = tarfile.open(file, mode)
+        else:
+            self.tar = tarfile.open(fileobj=file, mode=mode)
+        self.mtime = time.time()
+    
+    def info(self, name, size):
+        info = tarfile.TarInfo(name.encode('utf-8'))
+        info.size = size
+        info.mtime = self.mtime
+        info.mode = 0644
+        return info
+    
+    def write(self, name, data):
+        self.tar.addfile(self.info(name, len(data)), StringIO(data))
+    
+    def write_path(self, name, filename):
+        with open(filename, 'rb') as f:
+            f.seek(0, 2)
+            info = self.info(name, f.tell())
+            f.seek(0)
+            self.tar.addfile(info, f)
+    
+    def close(self):
+        self.tar.close()
+
+class ZipSink(Sink):
+    '''
+    Writes the files to the zip archive as they are generated.
+    '''
+    def __init__(self, file, compression=zipfile.ZIP_DEFLATED):
+        '''
+        Constructor.
+        file - archive file name or an open file
+        compression - zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED
+        '''
+        self.zip = zipfile.ZipFile(file, 'w', compression, True)
+        self.compression = compression
+        self.dateTime = time.localtime()[:6]
+    
+    # unicode names are stored in UTF-8 with the flag, set by zipfile
+    def write(self, name, data):
+        info = zipfile.ZipInfo(unicode(name), self.dateTime)
+        info.compress_type = self.compression
+        info.external_attr = 0644 << 16
+        self.zip.writestr(info, data)
+    
+    def write_path(self, name, filename):
+        self.zip.write(filename, unicode(name))
+        # the mode of the temporary file is not kept
+        self.zip.filelist[-1].external_attr = 0644 << 16
+    
+    def close(self):
+        self.zip.close()
 
 class ATG(object):
     '''
     Automatic Text Generator is a class, created to generate multiple
     text files from table data.
     '''
-    def __init__(self, data, template):
+    def __init__(self, data, template, stream=False, workers=1, state=None, select=None):
         '''
         Constructor.
         data - an instance of the data.Data class (i.e. CSVData)
         template - an instance of the template.Template class (i.e. TemplateV2)
+        stream - if True, nothing is generated in the constructor. Files are
+        generated one by one and written as soon as they are ready by
+        write_files, so generated texts are never held in memory all at once.
+        Generation and writing of the files are pipelined: writer threads
+        take the files through a bounded queue, while the next ones are
+        generated (see write_files and throughput).
+        workers - number of processes to render the rows in. Rows are split
+        into shards and the results are merged in the original order, so
+        the output is the same as with a single process.
+        state - file name to keep the hashes of the rows in for
+        the incremental mode. Only new rows and rows, which data (or data of
+        the rows, used by ATGPREV and ATGNEXT) has been changed since
+        the previous run, are generated and written. Implies stream.
+        The state is used only if there are multiple files and the header
+        and the footer of the template are static, all the rows are
+        generated otherwise.
+        select - rows to generate: a set of key values, an xrange or a slice
+        of row indexes, or a function, returning True for the DataRow
+        to generate (see template.RowFilter). Other rows are not written,
+        but ATGPREV, ATGNEXT, headers and footers are the same, as if all
+        the rows were generated. The state is not used with select.
+        
+        Nothing is generated in the constructor, texts are generated when
+        they are needed first (see out and write_files).
         '''
+        if state:
+            stream = True
         self.data = data
         self.template = template
-        self.out = template.process(data)
+        self.stream = stream
+        self.workers = workers
+        self.state = state
+        self.select = select
+        self.selector = None
+        self.sink = None
+        self.outputDir = '.'
+        self.dirs = set()
+        self.manifest = None
+        self.lock = threading.Lock()
+        self.reset_counters()
         
-        if type(self.out) == dict:
-            self.multiple = True
+        self.context = None
+        self._out = None
+    
+    def get_out(self):
+        '''
+        Returns a dictionary of generated texts by file names, or a single
+        text in the oneFile mode. Texts are generated on the first call.
+        None in the stream mode.
+        '''
+        if self._out is None and not self.stream:
+            start = time.time()
+            self._out = self.call_process()
+            self.stats['render'] = self.stats.get('render', 0.0) + time.time() - start
+        return self._out
+    
+    def set_out(self, value):
+        self._out = value
+    
+    out = property(get_out, set_out)
+    
+    def get_multiple(self):
+        if hasattr(self.template, 'oneFile'):
+            return not self.template.oneFile
+        return type(self.out) == dict
+    
+    multiple = property(get_multiple, doc='True if there are multiple files to write.')
+    
+    def call_process(self):
+        '''
+        Calls process of the template. Workers, the context and the selection
+        are passed only if process takes them, so templates with
+        process(self, data) still work.
+        '''
+        template = self.template
+        args, varargs, keywords, defaults = inspect.getargspec(template.process)
+        kwargs = {}
+        if 'workers' in args or keywords:
+            kwargs['workers'] = self.workers
+        if 'select' in args or keywords:
+            kwargs['select'] = self.select
+        elif not self.select is None:
+            raise BaseException('Template does not support the selection of rows')
+        if 'context' in args or keywords:
+            kwargs['context'] = self.context = template.new_context(self.data)
         else:
-            self.multiple = False
+            self.context = None
+        return template.process(self.data, **kwargs)
     
     def join_filename(self, path, name, extension):
         '''
@@ -38,48 +568,415 @@ class ATG(object):
             return join(unicode(path),name+'.'+extension)
         else:
             return join(unicode(path),name)
-	
-    def write_files(self, outputDir='.'):
+    
+    def make_dirs(self, outputDir, name):
+        '''
+        Creates directories for the file with given name. Created
+        directories are remembered until the next write_files call.
+        '''
+        namepath = name.replace('\\', '/').split('/')
+        path = join(unicode(outputDir), *namepath[:-1])
+        if not path in self.dirs:
+            if not exists(path):
+                makedirs(path)
+            self.dirs.add(path)
+    
+    def save(self, fname, text, encoding):
+        '''
+        Writes the text to the file. With the manifest, the file is not
+        written if its content is the same.
+        '''
+        data = text.encode(encoding)
+        manifest = self.manifest
+        if not manifest is None:
+            digest = hashlib.sha1(data).hexdigest()
+            if manifest.unchanged(fname, digest):
+                self.count('unchanged')
+                return
+        f = open(fname, 'w')
+        f.write(data)
+        self.log('   Saved %s' % fname)
+        f.close()
+        if not manifest is None:
+            manifest.update(fname, digest)
+        self.count('written')
+        self.count('bytes', len(data))
+    
+    def reset_counters(self):
+        '''
+        Resets the counters of the summary and the throughput report.
+        '''
+        self.written = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.bytes = 0
+        self.stats = {'render': 0.0, 'write': 0.0, 'stalled': 0.0, 'idle': 0.0, 'threads': 1}
+    
+    def count(self, name, n=1):
+        '''
+        Increases the counter of the summary.
+        '''
+        with self.lock:
+            setattr(self, name, getattr(self, name) + n)
+    
+    def summary(self):
+        '''
+        Returns the summary of the last write_files call.
+        '''
+        return 'written: %i, unchanged: %i, removed: %i' % (self.written, self.unchanged, self.removed)
+    
+    def throughput(self):
+        '''
+        Returns the report on the stages of the last write_files call:
+        generation (rendering of the files) and writing (encoding and
+        writing them), and which of them limits the speed.
+        '''
+        stats = self.stats
+        files = self.written + self.unchanged
+        render = stats['render']
+        write = stats['write'] / stats['threads']
+        mb = self.bytes / 1048576.0
+        lines = [
+            'generation: %i files in %.2fs (%.0f files/s)' % (files, render, files / render if render else 0),
+            'writing: %i files, %.1f MB in %.2fs by %i thread(s) (%.0f files/s, %.1f MB/s)' % (
+                self.written, mb, write, stats['threads'], self.written / write if write else 0, mb / write if write else 0),
+            'generation waited for writing %.2fs, writing waited for generation %.2fs' % (
+                stats['stalled'], stats['idle'] / stats['threads']),
+        ]
+        if render >= write:
+            lines.append('bound by: generation (CPU)')
+        else:
+            lines.append('bound by: writing (I/O)')
+        return '\n'.join(lines)
+    
+    def iter_files(self):
+        '''
+        Yields (name, text) pairs of the generated files.
+        '''
+        if self.stream:
+            ctx = self.context = self.template.new_context(self.data)
+            selector = ctx.selector = self.selector = self.new_selector()
+            for name, text in self.template.iter_process(self.data, self.workers, ctx, self.select):
+                if not selector is None:
+                    selector.named(ctx.element, name)
+                yield name, text
+        else:
+            for name in self.out.keys():
+                yield name, self.out[name]
+    
+    def write_files(self, outputDir='.', writers=4, manifest=False, clean=False):
         '''
         Write generated files to the given directory. 
+        
+        outputDir - directory name or a Sink (i.e. TarSink or ZipSink) to
+        write the files to. The sink is not closed. Manifest and incremental
+        state are used only with the directory.
+        writers - number of threads to write the files in, while the next
+        ones are generated (only if there are multiple files). Files are
+        written by the calling thread if it is 1.
+        manifest - if True (or a file name), content hashes of the files are
+        kept in the manifest (default: .atgmanifest in the output
+        directory), and files with the same content as in the previous run
+        are not written again.
+        clean - if True, files from the manifest, which are not generated
+        any more, are removed.
         '''
         encoding = self.template.encoding
         extension = self.template.extension
-        out = self.out
+        self.dirs = set()
+        self.reset_counters()
+        self.manifest = None
+        if isinstance(outputDir, DirectorySink):
+            outputDir = outputDir.path
+        elif isinstance(outputDir, Sink):
+            self.sink = outputDir
+            try:
+                self.write_sink(outputDir, encoding, extension)
+            finally:
+                self.sink = None
+            self.log(self.summary())
+            return
+        if manifest:
+            if not isinstance(manifest, basestring):
+                manifest = join(unicode(outputDir), '.atgmanifest')
+            self.manifest = Manifest(manifest, outputDir)
+        
+        self.outputDir = outputDir
+        self.write_outputs(outputDir, encoding, extension, writers)
+        
+        selector = self.selector
+        if not selector is None:
+            self.unchanged += len(selector.kept)
+            if not self.manifest is None:
+                for name in selector.kept:
+                    self.manifest.keep(self.output_name(outputDir, name, extension))
+        
+        if not self.manifest is None:
+            if clean:
+                for path in self.manifest.stale():
+                    fname = join(unicode(outputDir), path)
+                    if exists(fname):
+                        remove(fname)
+                        self.log('   Removed %s' % fname)
+                        self.removed += 1
+            else:
+                for path in self.manifest.stale():
+                    self.manifest.produced[path] = self.manifest.entries[path]
+            if not exists(unicode(outputDir)):
+                makedirs(unicode(outputDir))
+            self.manifest.save()
+        if not selector is None:
+            self.save_state()
+        self.log(self.summary())
+    
+    def write_sink(self, sink, encoding, extension):
+        '''
+        Writes the generated files to the sink.
+        '''
+        stats = self.stats
+        if self.multiple:
+            start = time.time()
+            for name, text in self.iter_files():
+                data = text.encode(encoding)
+                writing = time.time()
+                sink.write(self.member_name(name, extension), data)
+                stats['write'] += time.time() - writing
+                self.written += 1
+                self.bytes += len(data)
+            stats['render'] = time.time() - start - stats['write']
+        elif self.stream:
+            handle, tmpname = tempfile.mkstemp('.tmp', 'atg')
+            try:
+                f = fdopen(handle, 'wb')
+                try:
+                    self.write_single(f, encoding)
+                finally:
+                    f.close()
+                self.bytes += stat(tmpname).st_size
+                start = time.time()
+                sink.write_path(self.member_name(self.single_name(), extension), tmpname)
+                stats['write'] += time.time() - start
+            finally:
+                remove(tmpname)
+            self.written += 1
+        else:
+            data = self.out.encode(encoding)
+            start = time.time()
+            sink.write(self.member_name(self.single_name(), extension), data)
+            stats['write'] = time.time() - start
+            self.written += 1
+            self.bytes += len(data)
+    
+    def member_name(self, name, extension):
+        '''
+        Returns the name of the generated file in a sink: the same as in
+        the output directory, with '/' separators.
+        '''
+        return self.output_name(u'', name, extension).replace('\\', '/').lstrip('/')
+    
+    def output_name(self, outputDir, name, extension):
+        '''
+        Returns the file name for the generated file with given name in
+        the multiple files mode.
+        '''
+        fname = self.join_filename(outputDir, name, extension)
+        if fname.endswith('.'):
+            fname = fname[:-1]
+        return fname
+    
+    def state_hash(self):
+        '''
+        Returns the hash of everything, that affects the generated files,
+        except the rows: the template, the data columns and the output
+        directory.
+        '''
+        template = self.template
+        return hashlib.sha1(repr((template.text, template.keyField, template.extension,
+            template.prefix, template.encoding, list(self.data.keys),
+            abspath(unicode(self.outputDir))))).hexdigest()
+    
+    def new_selector(self):
+        '''
+        Returns the RowSelector for the incremental mode, or None if all
+        the rows should be generated.
+        '''
+        template = self.template
+        if not self.state or not self.multiple or not self.sink is None or not self.select is None or not hasattr(template, 'window_size'):
+            return None
+        if not template.header_is_static() or not template.footer_is_static():
+            return None
+        digest = self.state_hash()
+        old = {}
+        if exists(self.state):
+            try:
+                with open(self.state, 'rb') as f:
+                    if f.read(len(STATE_MAGIC)) == STATE_MAGIC:
+                        oldDigest, rows = marshal.load(f)
+                        if oldDigest == digest:
+                            old = rows
+            except (IOError, EOFError, ValueError, TypeError):
+                pass
+        behind, ahead = template.window_size()
+        outputDir = self.outputDir
+        extension = template.extension
+        listed = {}
+        def check(name):
+            # directories are listed once instead of checking every file
+            path, fname = split(self.output_name(outputDir, name, extension))
+            files = listed.get(path)
+            if files is None:
+                try:
+                    files = listed[path] = set(listdir(path))
+                except OSError:
+                    files = listed[path] = set()
+            return fname in files
+        return RowSelector(digest, old, self.data.key_index(template.keyField), behind, ahead, check)
+    
+    def save_state(self):
+        '''
+        Saves the hashes of the rows for the next run in the incremental mode.
+        '''
+        selector = self.selector
+        handle, tmpname = tempfile.mkstemp('.tmp', 'atg', dirname(abspath(self.state)))
+        with fdopen(handle, 'wb') as f:
+            f.write(STATE_MAGIC)
+            marshal.dump((selector.digest, selector.new), f, 2)
+        if exists(self.state):
+            remove(self.state)
+        rename(tmpname, self.state)
+        _reset_mode(self.state)
+    
+    def write_outputs(self, outputDir, encoding, extension, writers):
+        '''
+        Writes the generated files, see write_files.
+        '''
+        stats = self.stats
         if self.multiple:
-            for name in out.keys():
-                namepath = name.replace('\\', '/').split('/')
-                newpath = u''
-                for i in namepath[:-1]:
-                    newpath = join(newpath, i)
-                if not exists(join(unicode(outputDir), newpath)):
-                    makedirs(join(unicode(outputDir), newpath))
+            pool = None
+            if writers > 1:
+                pool = WriterPool(self.save, writers)
+            start = time.time()
+            try:
+                for name, text in self.iter_files():
+                    self.make_dirs(outputDir, name)
+                    fname = self.output_name(outputDir, name, extension)
+                    if pool is None:
+                        saving = time.time()
+                        self.save(fname, text, encoding)
+                        stats['write'] += time.time() - saving
+                    else:
+                        pool.put(fname, text, encoding)
+                stats['render'] = time.time() - start - stats['write']
+            finally:
+                if not pool is None:
+                    pool.close()
+            if not pool is None:
+                stats['render'] -= pool.stalled
+                stats['write'] = pool.busy
+                stats['idle'] = pool.idle
+                stats['stalled'] = pool.stalled
+                stats['threads'] = writers
+        elif self.stream:
+            if not exists(unicode(outputDir)):
+                makedirs(unicode(outputDir))
+            handle, tmpname = tempfile.mkstemp('.tmp', 'atg', unicode(outputDir))
+            try:
+                f = fdopen(handle, 'wb')
+                try:
+                    self.write_single(f, encoding)
+                finally:
+                    f.close()
+                name = self.single_name()
+                self.make_dirs(outputDir, name)
                 fname = self.join_filename(outputDir, name, extension)
-                if fname.endswith('.'):
-                    fname = fname[:-1]
-                f = open(fname, 'w')
-                f.write(out[name].encode(encoding))
+                manifest = self.manifest
+                if not manifest is None:
+                    digest = hashlib.sha1()
+                    with open(tmpname, 'rb') as f:
+                        chunk = f.read(65536)
+                        while chunk:
+                            digest.update(chunk)
+                            chunk = f.read(65536)
+                    digest = digest.hexdigest()
+                    if manifest.unchanged(fname, digest):
+                        self.count('unchanged')
+                        return
+                if exists(fname):
+                    remove(fname)
+                rename(tmpname, fname)
+                _reset_mode(fname)
                 self.log('   Saved %s' % fname)
-                f.close()
+                if not manifest is None:
+                    manifest.update(fname, digest)
+                self.count('written')
+                self.count('bytes', stat(fname).st_size)
+            finally:
+                if exists(tmpname):
+                    remove(tmpname)
         else:
-            name = self.template.bonusPrefix
-            if name == '.':
-                name = self.template.keyField
-            namepath = name.replace('\\', '/').split('/')
-            newpath = u''
-            for i in namepath[:-1]:
-                newpath = join(newpath, i)
-            if not exists(join(unicode(outputDir),newpath)):
-                makedirs(join(unicode(outputDir),newpath))
+            text = self.out
+            name = self.single_name()
+            self.make_dirs(outputDir, name)
             fname = self.join_filename(outputDir, name, extension)
-            f = open(fname, 'w')
-            f.write(out.encode(encoding))
-            self.log('   Saved %s' % fname)
-            f.close()
+            start = time.time()
+            self.save(fname, text, encoding)
+            stats['write'] = time.time() - start
+    
+    def single_name(self):
+        '''
+        Returns the name of the file in the oneFile mode.
+        '''
+        if self.context is None:
+            name = self.template.bonusPrefix
+        else:
+            name = self.context.prefix
+        if name == '.':
+            name = self.template.keyField
+        return name
+    
+    def write_single(self, f, encoding, size=65536):
+        '''
+        Generates the text in the oneFile mode and writes it to the open file:
+        the header, the text of each row and the footer, without joining
+        them in memory. If the header can be changed by the rows, rows are
+        collected in a temporary file first.
+        '''
+        template = self.template
+        ctx = self.context = template.new_context(self.data)
+        start = time.time()
+        writer = ChunkWriter(f, encoding, size)
+        rows = template.iter_process(self.data, self.workers, ctx, self.select)
+        if template.header_is_static():
+            first = next(rows, None)
+            writer.write(ctx.header)
+            if not first is None:
+                writer.write(first[1])
+            for name, text in rows:
+                writer.write(text)
+        else:
+            spool = tempfile.TemporaryFile()
+            try:
+                spooler = ChunkWriter(spool, 'utf-8', size)
+                for name, text in rows:
+                    spooler.write(text)
+                spooler.close()
+                spool.seek(0)
+                writer.write(ctx.header)
+                decoder = codecs.getincrementaldecoder('utf-8')()
+                chunk = spool.read(size)
+                while chunk:
+                    writer.write(decoder.decode(chunk))
+                    chunk = spool.read(size)
+            finally:
+                spool.close()
+        writer.write(ctx.footer)
+        writer.close()
+        self.stats['write'] += writer.busy
+        self.stats['render'] += time.time() - start - writer.busy
     
     def log(self, text):
         '''
         Print information
         '''
         #print 'ATG:', text
-        pass
\ No newline at end of file
+        pass
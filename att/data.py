@@ -8,12 +8,147 @@ Data module for a Automatic Text Tools.
 License: GPLv3
 '''
 
-import csv, codecs, cStringIO
+import csv, codecs, cStringIO, mmap, marshal, sqlite3
+from array import array
+from itertools import izip, islice
+from os.path import exists, getsize, getmtime, abspath
+
+SNAPSHOT_MAGIC = 'ATGSNAP2'
+
+class DataRow(object):
+    '''
+    A single row of the data, accessible by the column headers.
+    '''
+    __slots__ = ('index', 'values')
+    
+    def __init__(self, index, values):
+        '''
+        Constructor.
+        
+        index - dictionary of column indexes by headers
+        values - list of row values
+        '''
+        self.index = index
+        self.values = values
+    
+    def __getitem__(self, key):
+        '''
+        Returns a value for given key.
+        '''
+        idx = self.index.get(key)
+        if idx is None:
+            raise BaseException('Named value %s not found in data' % (key))
+        return self.values[idx]
+    
+    def __contains__(self, key):
+        return key in self.index
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self):
+        return len(self.index)
+    
+    def get(self, key, default=None):
+        '''
+        Returns a value for given key or default if there is no such key.
+        '''
+        idx = self.index.get(key)
+        if idx is None:
+            return default
+        return self.values[idx]
+    
+    def keys(self):
+        '''
+        Returns the list of column headers.
+        '''
+        return sorted(self.index, key=self.index.get)
+    
+    def items(self):
+        '''
+        Returns the list of (key, value) pairs.
+        '''
+        return [(k, self.values[self.index[k]]) for k in self.keys()]
+
+class KeyList(list):
+    '''
+    List of the column headers of Data. Any change of the list makes
+    the data rebuild the index of the columns on the next lookup.
+    '''
+    data = None
+    
+    def __init__(self, keys=(), data=None):
+        list.__init__(self, keys)
+        self.data = data
+    
+    def changed(self):
+        data = self.data
+        if not data is None:
+            data._keyIndex = None
+            data._groups = None
+    
+    def __setitem__(self, i, value):
+        list.__setitem__(self, i, value)
+        self.changed()
+    
+    def __delitem__(self, i):
+        list.__delitem__(self, i)
+        self.changed()
+    
+    def __setslice__(self, i, j, values):
+        list.__setslice__(self, i, j, values)
+        self.changed()
+    
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self.changed()
+    
+    def __iadd__(self, values):
+        list.extend(self, values)
+        self.changed()
+        return self
+    
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self.changed()
+        return self
+    
+    def append(self, value):
+        list.append(self, value)
+        self.changed()
+    
+    def extend(self, values):
+        list.extend(self, values)
+        self.changed()
+    
+    def insert(self, i, value):
+        list.insert(self, i, value)
+        self.changed()
+    
+    def pop(self, *args):
+        value = list.pop(self, *args)
+        self.changed()
+        return value
+    
+    def remove(self, value):
+        list.remove(self, value)
+        self.changed()
+    
+    def reverse(self):
+        list.reverse(self)
+        self.changed()
+    
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self.changed()
 
 class Data(object):
     '''
     Empty data class. Can be used for a subclassing or procedural data creation.
     '''
+    # rows are in memory and may be read more than once
+    randomAccess = True
+    
     def __init__(self, *args, **kwargs):
         '''
         Constructor
@@ -21,6 +156,38 @@ class Data(object):
         self.keys = []
         self.rows = []
     
+    def get_keys(self):
+        return self._keys
+    
+    def set_keys(self, keys):
+        if not keys is None and not (isinstance(keys, KeyList) and keys.data is self):
+            keys = KeyList(keys, self)
+        self._keys = keys
+        self.reindex()
+    
+    keys = property(get_keys, set_keys, doc='''List of the column headers
+    (a KeyList, assigned lists are copied). The index of the columns is
+    rebuilt after the list has been changed.''')
+    
+    def reindex(self):
+        '''
+        Rebuilds the index of the columns.
+        '''
+        index = {}
+        keys = self._keys or []
+        for i in xrange(len(keys)-1, -1, -1):
+            index[keys[i]] = i
+        self._keyIndex = index
+        self._groups = None
+    
+    def key_index(self, key):
+        '''
+        Returns an index of the column with given header or None.
+        '''
+        if self._keyIndex is None:
+            self.reindex()
+        return self._keyIndex.get(key)
+    
     def __getitem__(self, pair):
         '''
         Returns a value for given key and row. 
@@ -28,11 +195,11 @@ class Data(object):
         key = pair[0]
         row = pair[1]
         
-        keys = self.keys
+        idx = self.key_index(key)
         rows = self.rows
-        if key in keys:
+        if not idx is None:
             if len(rows) > row:
-                return rows[row][keys.index(key)]
+                return rows[row][idx]
             else:
                 raise BaseException('Row %i not found in data' % (row))
         else:
@@ -45,16 +212,71 @@ class Data(object):
         key = pair[0]
         row = pair[1]
         
-        keys = self.keys
+        idx = self.key_index(key)
         rows = self.rows
-        if key in keys:
+        if not idx is None:
             if len(rows) > row:
-                rows[row][keys.index(key)] = value
+                rows[row][idx] = value
             else:
                 raise BaseException('Row %i not found in data' % (row))
         else:
             raise BaseException('Named value %s not found in data' % (key))
     
+    def groups(self):
+        '''
+        Returns the multi-column groups of the data: a dictionary, where
+        the keys are the headers without the trailing numbers (i.e. 'Col' for
+        'Col1', 'Col2', 'Col3') and the values are the tuples of column
+        indexes of 'Col1', 'Col2' etc. (None if there is no such column).
+        The result is cached until the keys are changed.
+        '''
+        if self._keyIndex is None:
+            self.reindex()
+        if self._groups is None:
+            counts = {}
+            order = []
+            for i in self._keys or []:
+                if not isinstance(i, basestring):
+                    continue
+                stem = i.rstrip('0123456789')
+                if stem and not stem == i:
+                    if stem in counts:
+                        counts[stem] += 1
+                    else:
+                        counts[stem] = 1
+                        order.append(stem)
+            index = self._keyIndex
+            groups = {}
+            for stem in order:
+                groups[stem] = tuple([index.get(stem+str(j)) for j in xrange(1, counts[stem]+1)])
+            self._groups = groups
+        return self._groups
+    
+    def value_at(self, key, row, offset=0):
+        '''
+        Returns a value for given key from the row with given offset
+        from the given row (negative offset - previous rows).
+        '''
+        idx = self.key_index(key)
+        if idx is None:
+            raise BaseException('Named value %s not found in data' % (key))
+        target = row + offset
+        if target < 0 or target >= len(self.rows):
+            raise BaseException('Row %i not found in data' % (target))
+        return self.rows[target][idx]
+    
+    def lag(self, key, row, n=1):
+        '''
+        Returns a value for given key from the n-th row before the given one.
+        '''
+        return self.value_at(key, row, -n)
+    
+    def lead(self, key, row, n=1):
+        '''
+        Returns a value for given key from the n-th row after the given one.
+        '''
+        return self.value_at(key, row, n)
+    
     def __str__(self):
         '''
         Returns data as string.
@@ -68,7 +290,7 @@ class Data(object):
         '''
         Returns True if given key exists in data
         '''
-        return key in self.keys
+        return not self.key_index(key) is None
     
     def add_rows(self, n=1):
         '''
@@ -90,11 +312,13 @@ class Data(object):
         keys = self.keys
         rows = self.rows
         
-        for i in h:
-            keys.append(i)
-        for r in rows:
-            for i in h:
-                r.append('')
+        keys.extend(h)
+        if isinstance(rows, CompactRows):
+            rows.add_columns(len(h))
+        else:
+            empty = [''] * len(h)
+            for r in rows:
+                r.extend(empty)
     
     def del_row(self, idx):
         '''
@@ -102,13 +326,19 @@ class Data(object):
         '''
         del self.rows[idx]
     
+    def compact(self):
+        '''
+        Moves the rows to the compact column-wise storage (see CompactRows).
+        '''
+        if not isinstance(self.rows, CompactRows):
+            self.rows = CompactRows(self.rows, len(self.keys or []))
+    
     def col_by_key(self, key):
         '''
         Returns a column by header's name
         '''
-        keys = self.keys
-        if key in keys:
-            idx = keys.index(key)
+        idx = self.key_index(key)
+        if not idx is None:
             return self.col_by_idx(idx)
         else:
             raise BaseException('Named value %s not found in data' % (key))
@@ -130,12 +360,38 @@ class Data(object):
         '''
         return tuple(self.rows[idx])
     
-    def transpose(self, key_idx = 0):
+    def key_map(self):
+        '''
+        Returns the dictionary of column indexes by headers.
+        '''
+        if self._keyIndex is None:
+            self.reindex()
+        return self._keyIndex
+    
+    def row_map(self, idx):
+        '''
+        Returns a row by index as a DataRow, values can be taken by headers.
+        '''
+        return DataRow(self.key_map(), self.rows[idx])
+    
+    def iter_rows(self):
+        '''
+        Returns an iterator over the rows. Templates read the data only
+        through it, so it can be replaced in subclasses to read rows lazily.
+        '''
+        return iter(self.rows)
+    
+    def transpose(self, key_idx = 0, view = False):
         '''
         Returns the transposed copy of the data.
         
         key_idx - index of the column, that contains keywords (default: 0)
+        view - if True, returns a TransposedData view of this data instead
+        of the copy (default: False)
         '''
+        if view:
+            return TransposedData(self, key_idx)
+        
         new_keys = [self.keys[key_idx]]
         new_keys += list(self.col_by_idx(key_idx))
         new_data = Data()
@@ -153,24 +409,495 @@ class Data(object):
     
     def add_data(self, other):
         '''
-        Adds rows from another data table to this one.
+        Adds rows from another data table to this one. Columns, missing
+        in this table, are added, missing values are filled with
+        empty strings.
+        '''
+        newKeys = []
+        for k in other.keys:
+            if not self.has_key(k) and not k in newKeys:
+                newKeys.append(k)
+        if newKeys:
+            self.add_keys(*newKeys)
+        
+        mapping = [other.key_index(k) for k in self.keys]
+        rows = self.rows
+        for r in other.iter_rows():
+            width = len(r)
+            rows.append([r[i] if not i is None and i < width else '' for i in mapping])
+    
+    def join(self, other, key, how='left', other_key=None):
+        '''
+        Returns a new data table with the rows of this one, joined with the
+        rows of another table, which have the same value in the key column.
+        Columns of the other table, that are not in this one, are added
+        to the right.
+        
+        other - data table to join
+        key - header of the key column in this table
+        how - 'left' to keep the rows without a match (with empty values
+        in the new columns) or 'inner' to drop them (default: left)
+        other_key - header of the key column in the other table
+        (default: same as key)
         '''
-        sk = self.keys
-        ok = other.keys
+        if not how in ('left', 'inner'):
+            raise BaseException('Unknown join type %s' % (how))
+        if other_key is None:
+            other_key = key
+        keyIdx = self.key_index(key)
+        if keyIdx is None:
+            raise BaseException('Named value %s not found in data' % (key))
+        otherIdx = other.key_index(other_key)
+        if otherIdx is None:
+            raise BaseException('Named value %s not found in data' % (other_key))
         
-        for k in ok:
-            if not k in sk:
-                self.add_keys(k)
+        added = []
+        for k in other.keys:
+            if not k == other_key and not self.has_key(k) and not k in added:
+                added.append(k)
+        mapping = [other.key_index(k) for k in added]
         
-        for r in  other.rows:
-            new_row = []
-            if len(r) >= len(sk):
-                for k in sk:
-                    if k in ok:
-                        new_row.append(r[ok.index(k)])
-                    else:
-                        new_row.append('')
-            self.rows.append(new_row)
+        index = {}
+        for r in other.iter_rows():
+            if len(r) > otherIdx:
+                width = len(r)
+                values = [r[i] if i < width else '' for i in mapping]
+                if r[otherIdx] in index:
+                    index[r[otherIdx]].append(values)
+                else:
+                    index[r[otherIdx]] = [values]
+        
+        new_data = Data()
+        new_data.keys = list(self.keys) + added
+        rows = new_data.rows
+        empty = [[''] * len(added)]
+        inner = how == 'inner'
+        width = len(self.keys)
+        for r in self.iter_rows():
+            matches = None
+            if len(r) > keyIdx:
+                matches = index.get(r[keyIdx])
+            if matches is None:
+                if inner:
+                    continue
+                matches = empty
+            r = list(r)
+            if len(r) < width:
+                r += [''] * (width - len(r))
+            for values in matches:
+                rows.append(r + values)
+        return new_data
+
+class TransposedData(Data):
+    '''
+    Transposed view of the data. Nothing is copied: values are read from
+    the rows of the original data by swapped indexes, and the values, set
+    through the view, are written to the original data. Keys of the view
+    are taken from the key column once, so rows and columns added to the
+    original data later are not visible in the view.
+    Use materialize() to get a transposed copy.
+    '''
+    class Row(object):
+        '''
+        Row of the view - a column of the original data.
+        '''
+        __slots__ = ('source', 'column')
+        
+        def __init__(self, source, column):
+            self.source = source
+            self.column = column
+        
+        def __len__(self):
+            return len(self.source.rows) + 1
+        
+        def __getitem__(self, idx):
+            if isinstance(idx, slice):
+                return [self[i] for i in xrange(*idx.indices(len(self)))]
+            if idx < 0:
+                idx += len(self)
+            if idx == 0:
+                return self.source.keys[self.column]
+            if idx < 0:
+                raise IndexError(idx)
+            r = self.source.rows[idx-1]
+            if len(r) > self.column:
+                return r[self.column]
+            return ''
+        
+        def __setitem__(self, idx, value):
+            if idx < 0:
+                idx += len(self)
+            if idx <= 0:
+                raise BaseException('Keys can not be changed through the transposed view')
+            self.source.rows[idx-1][self.column] = value
+        
+        def __iter__(self):
+            column = self.column
+            yield self.source.keys[column]
+            for r in self.source.rows:
+                if len(r) > column:
+                    yield r[column]
+                else:
+                    yield ''
+    
+    class Rows(object):
+        '''
+        List-like access to the rows of the view.
+        '''
+        def __init__(self, data):
+            self.data = data
+        
+        def __len__(self):
+            return len(self.data.columns)
+        
+        def __getitem__(self, idx):
+            if isinstance(idx, slice):
+                return [self[i] for i in xrange(*idx.indices(len(self)))]
+            return TransposedData.Row(self.data.source, self.data.columns[idx])
+        
+        def __iter__(self):
+            source = self.data.source
+            for c in self.data.columns:
+                yield TransposedData.Row(source, c)
+    
+    def __init__(self, data, key_idx=0):
+        '''
+        Constructor.
+        
+        data - the data to transpose
+        key_idx - index of the column, that contains keywords (default: 0)
+        '''
+        self.source = data
+        self.key_idx = key_idx
+        self.columns = [i for i in xrange(len(data.keys)) if not i == key_idx]
+        self.keys = [data.keys[key_idx]] + list(data.col_by_idx(key_idx))
+        self.rows = self.Rows(self)
+    
+    def iter_rows(self):
+        '''
+        Yields the rows of the view as lists.
+        '''
+        for r in self.rows:
+            yield list(r)
+    
+    def materialize(self):
+        '''
+        Returns the transposed copy of the data.
+        '''
+        new_data = Data()
+        new_data.keys = list(self.keys)
+        new_data.rows = list(self.iter_rows())
+        return new_data
+    
+    def read_only(self, *args, **kwargs):
+        '''
+        Raises an exception: rows and columns of the view can not be
+        added or removed.
+        '''
+        raise BaseException('Transposed view can not be resized, use materialize() first')
+    
+    add_rows = read_only
+    add_keys = read_only
+    del_row = read_only
+    add_data = read_only
+
+class CompactRows(object):
+    '''
+    Compact column-wise storage of the rows. Numeric columns are kept in
+    typed arrays, text columns - as arrays of indexes to a table of unique
+    values, so every repeated string is stored only once. Columns with
+    mixed values are kept as lists.
+    
+    Rows, taken by index, are views to the storage: values, set through
+    them, are written to the storage. Iteration yields copies of the rows
+    as lists.
+    '''
+    class Row(object):
+        '''
+        A single row of the storage.
+        '''
+        __slots__ = ('rows', 'idx')
+        
+        def __init__(self, rows, idx):
+            self.rows = rows
+            self.idx = idx
+        
+        def __len__(self):
+            return self.rows.row_length(self.idx)
+        
+        def __getitem__(self, k):
+            if isinstance(k, slice):
+                return list(self)[k]
+            if k < 0:
+                k += len(self)
+            if k < 0 or k >= len(self):
+                raise IndexError(k)
+            return self.rows.get(self.idx, k)
+        
+        def __setitem__(self, k, value):
+            if k < 0:
+                k += len(self)
+            if k < 0 or k >= len(self):
+                raise IndexError(k)
+            self.rows.set(self.idx, k, value)
+        
+        def __iter__(self):
+            get = self.rows.get
+            idx = self.idx
+            for k in xrange(len(self)):
+                yield get(idx, k)
+        
+        def __eq__(self, other):
+            try:
+                return list(self) == list(other)
+            except TypeError:
+                return False
+        
+        def __ne__(self, other):
+            return not self == other
+        
+        def __repr__(self):
+            return repr(list(self))
+    
+    def __init__(self, rows=(), width=0):
+        '''
+        Constructor.
+        
+        rows - list of the rows to store
+        width - minimal number of columns
+        '''
+        rows = list(rows)
+        lengths = [len(r) for r in rows]
+        self.count = len(rows)
+        self.width = max([width] + lengths)
+        if [l for l in lengths if not l == self.width]:
+            self.lengths = array('L', lengths)
+        else:
+            self.lengths = None
+        if self.lengths is None and rows:
+            self.columns = map(self.pack, izip(*rows))
+        else:
+            self.columns = [self.pack([r[k] if len(r) > k else u'' for r in rows]) for k in xrange(self.width)]
+    
+    @staticmethod
+    def index_code(size):
+        '''
+        Returns the smallest array type code for indexes to a table of
+        the given size.
+        '''
+        if size <= 0x100:
+            return 'B'
+        elif size <= 0x10000:
+            return 'H'
+        return 'L'
+    
+    @staticmethod
+    def pack(column):
+        '''
+        Returns the compact storage for the list of the column values:
+        [type code, values, extra]. Empty values of numeric columns are
+        kept in the extra set of indexes, unique values of text columns -
+        in the extra [list, dictionary] pair. The dictionary is built on
+        the first change of the column.
+        '''
+        kinds = set(map(type, column))
+        text = set([unicode, str])
+        numeric = kinds - text
+        hasText = kinds & text
+        if (numeric == set([int]) or numeric == set([float])) and not (hasText and [v for v in column if type(v) in text and v]):
+            code = 'l' if int in kinds else 'd'
+            empty = set([i for i in xrange(len(column)) if type(column[i]) in text]) if hasText else set()
+            try:
+                values = array(code, [0 if i in empty else column[i] for i in xrange(len(column))] if empty else column)
+                return [code, values, empty]
+            except OverflowError:
+                pass
+        if kinds <= text:
+            strings = list(set(column))
+            table = dict(izip(strings, xrange(len(strings))))
+            return ['s', array(CompactRows.index_code(len(strings)), map(table.__getitem__, column)), [strings, None]]
+        return ['o', list(column), None]
+    
+    @staticmethod
+    def unpack(column, start=0, stop=None):
+        '''
+        Returns the list of the column values from the compact storage.
+        '''
+        code, values, extra = column
+        values = values[start:stop]
+        if code == 's':
+            return map(extra[0].__getitem__, values)
+        elif code == 'o':
+            return values
+        values = values.tolist()
+        if extra:
+            stop = start + len(values)
+            for i in extra:
+                if start <= i < stop:
+                    values[i - start] = u''
+        return values
+    
+    def __len__(self):
+        return self.count
+    
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.Row(self, i) for i in xrange(*idx.indices(self.count))]
+        if idx < 0:
+            idx += self.count
+        if idx < 0 or idx >= self.count:
+            raise IndexError(idx)
+        return self.Row(self, idx)
+    
+    def __setitem__(self, idx, row):
+        if idx < 0:
+            idx += self.count
+        if idx < 0 or idx >= self.count:
+            raise IndexError(idx)
+        self.set_row(idx, row)
+    
+    def __delitem__(self, idx):
+        if idx < 0:
+            idx += self.count
+        if idx < 0 or idx >= self.count:
+            raise IndexError(idx)
+        for column in self.columns:
+            del column[1][idx]
+            if column[0] in ('l', 'd'):
+                column[2] = set([i if i < idx else i - 1 for i in column[2] if not i == idx])
+        if not self.lengths is None:
+            del self.lengths[idx]
+        self.count -= 1
+    
+    def __iter__(self):
+        count = self.count
+        for start in xrange(0, count, 1000):
+            stop = min(start + 1000, count)
+            if self.columns:
+                rows = map(list, izip(*[self.unpack(c, start, stop) for c in self.columns]))
+            else:
+                rows = [[] for i in xrange(start, stop)]
+            lengths = self.lengths
+            if not lengths is None:
+                for i in xrange(start, stop):
+                    del rows[i - start][lengths[i]:]
+            for r in rows:
+                yield r
+    
+    def row_length(self, idx):
+        if self.lengths is None:
+            return self.width
+        return self.lengths[idx]
+    
+    def get(self, idx, k):
+        '''
+        Returns the value of the k-th column in the given row.
+        '''
+        code, values, extra = self.columns[k]
+        if code == 's':
+            return extra[0][values[idx]]
+        elif code == 'o' or not idx in extra:
+            return values[idx]
+        return u''
+    
+    def intern(self, column, value):
+        '''
+        Returns the index of the value in the table of a text column,
+        adding the value to the table if it is new.
+        '''
+        strings, table = column[2]
+        if table is None:
+            table = column[2][1] = dict([(strings[i], i) for i in xrange(len(strings) - 1, -1, -1)])
+        i = table.get(value)
+        if i is None:
+            i = table[value] = len(strings)
+            strings.append(value)
+            code = self.index_code(len(strings))
+            if not code == column[1].typecode:
+                column[1] = array(code, column[1])
+        return i
+    
+    def set(self, idx, k, value):
+        '''
+        Sets the value of the k-th column in the given row. The column is
+        turned into a list, if the value does not fit its type.
+        '''
+        column = self.columns[k]
+        code, values, extra = column
+        kind = type(value)
+        if code == 'o':
+            values[idx] = value
+            return
+        elif code == 's':
+            if kind is unicode or kind is str:
+                i = self.intern(column, value)
+                column[1][idx] = i
+                return
+        elif value == u'':
+            extra.add(idx)
+            return
+        elif (kind is int and code == 'l') or (kind is float and code == 'd'):
+            try:
+                values[idx] = value
+                extra.discard(idx)
+                return
+            except OverflowError:
+                pass
+        column[:] = ['o', self.unpack(column), None]
+        column[1][idx] = value
+    
+    def set_row(self, idx, row):
+        '''
+        Replaces the values of the given row.
+        '''
+        if len(row) > self.width:
+            self.add_columns(len(row) - self.width, False)
+        for k in xrange(self.width):
+            self.set(idx, k, row[k] if k < len(row) else u'')
+        if self.lengths is None and not len(row) == self.width:
+            self.lengths = array('L', [self.width] * self.count)
+        if not self.lengths is None:
+            self.lengths[idx] = len(row)
+    
+    def append(self, row):
+        '''
+        Adds a row to the end of the storage.
+        '''
+        for column in self.columns:
+            code, values, extra = column
+            if code == 'o':
+                values.append(u'')
+            elif code == 's':
+                i = self.intern(column, u'')
+                column[1].append(i)
+            else:
+                values.append(0)
+                extra.add(self.count)
+        if not self.lengths is None:
+            self.lengths.append(self.width)
+        self.count += 1
+        self.set_row(self.count - 1, row)
+    
+    def extend(self, rows):
+        '''
+        Adds the rows to the end of the storage.
+        '''
+        for r in rows:
+            self.append(r)
+    
+    def add_columns(self, n, extend=True):
+        '''
+        Adds n empty columns. If extend is True, rows are extended by n
+        empty values, as lists are by the list.extend().
+        '''
+        for i in xrange(n):
+            self.columns.append(['s', array('B', [0] * self.count), [[u''], None]])
+        self.width += n
+        if extend and not self.lengths is None:
+            for i in xrange(self.count):
+                self.lengths[i] += n
+        elif not extend and self.lengths is None and self.count:
+            self.lengths = array('L', [self.width - n] * self.count)
 
 class CSVData(Data):
     '''
@@ -199,25 +926,57 @@ class CSVData(Data):
             return self
     
     class Writer:
-        def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwargs):
+        '''
+        CSV writer for unicode rows. writerow writes the row to the file
+        at once. writerows writes the rows to the buffer, recodes them to
+        the file in batches of buffer_size bytes and flushes the rest
+        in the end. flush writes the buffered rows to the file.
+        '''
+        def __init__(self, f, dialect=csv.excel, encoding="utf-8", buffer_size=1048576, **kwargs):
             self.queue = cStringIO.StringIO()
             self.writer = csv.writer(self.queue, dialect=dialect, **kwargs)
             self.stream = f
-            self.encoder = codecs.getincrementalencoder(encoding)()
+            self.bufferSize = buffer_size
+            if codecs.lookup(encoding).name == 'utf-8':
+                self.encoder = None
+            else:
+                self.encoder = codecs.getincrementalencoder(encoding)()
+    
+        def encode_row(self, row):
+            # one encode call per row, cells are separated by NUL
+            cells = u'\x00'.join(map(unicode, row)).encode("utf-8").split('\x00')
+            if len(cells) == len(row):
+                return cells
+            return [unicode(s).encode("utf-8") for s in row]
     
         def writerow(self, row):
-            self.writer.writerow([unicode(s).encode("utf-8") for s in row])
-            data = self.queue.getvalue()
-            data = data.decode("utf-8")
-            data = self.encoder.encode(data)
-            self.stream.write(data)
-            self.queue.truncate(0)
+            self.writer.writerow(self.encode_row(row))
+            self.flush()
     
         def writerows(self, rows):
-            for row in rows:
-                self.writerow(row)
+            rows = iter(rows)
+            while True:
+                batch = map(self.encode_row, islice(rows, 1000))
+                if not batch:
+                    break
+                self.writer.writerows(batch)
+                if self.queue.tell() >= self.bufferSize:
+                    self.flush()
+            self.flush()
     
-    def __init__(self, file, encoding='utf-8', delimiter=',', quotechar='"', **kwargs):
+        def flush(self):
+            '''
+            Writes the buffered rows to the file.
+            '''
+            data = self.queue.getvalue()
+            if data:
+                if self.encoder:
+                    data = self.encoder.encode(data.decode("utf-8"))
+                self.stream.write(data)
+                self.queue.seek(0)
+                self.queue.truncate()
+    
+    def __init__(self, file, encoding='utf-8', delimiter=',', quotechar='"', types=None, sample=100, raw=False, cache=False, compact=False, **kwargs):
         '''
         Constructor.
         
@@ -225,7 +984,33 @@ class CSVData(Data):
         encoding - CSV table encoding (default: utf-8)
         delimiter - CSV table delimiter (default: ;)
         quotechar - CSV table quotechar (default: ")
+        types - dictionary of column types by headers (int, float or unicode).
+        Types of other columns are detected from the first rows.
+        sample - number of rows to detect the column types from (default: 100)
+        raw - if True, all values are kept as strings (default: False)
+        cache - if True (or a snapshot filename), the parsed data is saved to
+        a binary snapshot (default: filename.snapshot) and is loaded from it
+        next time, while the file and the parsing options are the same.
+        compact - if True, the rows are kept in the compact storage, see
+        CompactRows (default: False)
         '''
+        self.types = types
+        self.sample = sample
+        self.raw = raw
+        self.columnTypes = None
+        
+        snapshot = None
+        if cache and type(file) == str:
+            if isinstance(cache, basestring):
+                snapshot = cache
+            else:
+                snapshot = file + '.snapshot'
+            stamp = self.snapshot_stamp(file, encoding, delimiter, quotechar)
+            if self.load_snapshot(snapshot, stamp):
+                if compact:
+                    self.compact()
+                return
+        
         f = None
         if file:
             if type(file) == str:
@@ -241,24 +1026,252 @@ class CSVData(Data):
                 if not source_keys:
                     source_keys = i
                 else:
-                    for k in xrange(0, len(i)):
-                        try:
-                            i[k] = int(i[k])
-                        except:
-                            try:
-                                i[k] = float(i[k])
-                            except:
-                                i[k] = i[k]
                     source_data.append(i)
             
             self.keys = source_keys
-            self.rows = source_data
+            self.rows = self.convert_rows(source_data)
             if not f is None:
                 f.close();
+            if snapshot:
+                self.save_snapshot(snapshot, stamp)
+            if compact:
+                self.compact()
         else:
             super(CSVData, self).__init__()
     
-    def export_csv(self, filename, encoding='utf-8', delimiter=';', quotechar='"', **kwargs):
+    def snapshot_stamp(self, filename, encoding, delimiter, quotechar):
+        '''
+        Returns the dictionary, identifying the source file and the parsing
+        options of the snapshot.
+        '''
+        types = None
+        if self.types:
+            types = sorted([(k, getattr(v, '__name__', str(v))) for k, v in self.types.items()])
+        return {
+            'source': abspath(filename),
+            'size': getsize(filename),
+            'mtime': repr(getmtime(filename)),
+            'options': repr((encoding, delimiter, quotechar, types, self.sample, self.raw)),
+        }
+    
+    def save_snapshot(self, filename, stamp):
+        '''
+        Saves the keys and rows to the binary snapshot. Values are stored
+        by columns: numeric columns as typed arrays, other columns as
+        a table of unique strings and an array of indexes to it.
+        '''
+        rows = self.rows
+        count = len(self.keys or [])
+        lengths = None
+        for r in rows:
+            if not len(r) == count:
+                lengths = array('L', [len(r) for r in rows]).tostring()
+                count = max([count] + [len(r) for r in rows])
+                break
+        columnTypes = [getattr(t, '__name__', None) for t in self.columnTypes or []]
+        try:
+            with open(filename, 'wb') as f:
+                f.write(SNAPSHOT_MAGIC)
+                marshal.dump((stamp, list(self.keys), len(rows), count, lengths, columnTypes), f, 2)
+                for k in xrange(count):
+                    column = [r[k] if len(r) > k else u'' for r in rows]
+                    marshal.dump(self.pack_column(column), f, 2)
+        except IOError:
+            pass
+    
+    @staticmethod
+    def pack_column(column):
+        '''
+        Returns the compact representation of the column for the snapshot.
+        '''
+        kinds = set([type(v) for v in column if not v == u''])
+        empty = [i for i in xrange(len(column)) if column[i] == u''] if kinds else []
+        if len(kinds) == 1 and (int in kinds or float in kinds):
+            code = 'l' if int in kinds else 'd'
+            try:
+                values = array(code, [0 if v == u'' else v for v in column])
+                return (code, values.tostring(), array('L', empty).tostring())
+            except OverflowError:
+                pass
+        if not kinds or kinds <= set([unicode, str]):
+            table = {}
+            strings = []
+            indexes = []
+            for v in column:
+                i = table.get(v)
+                if i is None:
+                    i = table[v] = len(strings)
+                    strings.append(v)
+                indexes.append(i)
+            if len(strings) <= 0x100:
+                code = 'B'
+            elif len(strings) <= 0x10000:
+                code = 'H'
+            else:
+                code = 'L'
+            return ('s', strings, code + array(code, indexes).tostring())
+        return ('o', column, None)
+    
+    @staticmethod
+    def unpack_column(packed):
+        '''
+        Returns the list of the column values from the snapshot.
+        '''
+        code, values, extra = packed
+        if code == 's':
+            indexes = array(extra[0])
+            indexes.fromstring(extra[1:])
+            return [values[i] for i in indexes]
+        elif code == 'o':
+            return values
+        column = array(code)
+        column.fromstring(values)
+        column = column.tolist()
+        empty = array('L')
+        empty.fromstring(extra)
+        for i in empty:
+            column[i] = u''
+        return column
+    
+    def load_snapshot(self, filename, stamp):
+        '''
+        Loads the keys and rows from the binary snapshot. Returns False
+        if there is no snapshot or it does not match the stamp.
+        '''
+        if not exists(filename):
+            return False
+        try:
+            with open(filename, 'rb') as f:
+                if not f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC:
+                    return False
+                oldStamp, keys, count, width, lengths, columnTypes = marshal.load(f)
+                if not oldStamp == stamp:
+                    return False
+                columns = [self.unpack_column(marshal.load(f)) for k in xrange(width)]
+        except (IOError, EOFError, ValueError, TypeError):
+            return False
+        
+        if columns:
+            rows = [list(r) for r in izip(*columns)]
+        else:
+            rows = [[] for i in xrange(count)]
+        if not lengths is None:
+            sizes = array('L')
+            sizes.fromstring(lengths)
+            for i in xrange(count):
+                del rows[i][sizes[i]:]
+        names = {'int': int, 'float': float, 'unicode': unicode, 'convert_number': self.convert_number}
+        self.keys = keys
+        self.rows = rows
+        self.columnTypes = [names.get(t) for t in columnTypes]
+        return True
+    
+    @staticmethod
+    def convert_value(value):
+        '''
+        Returns the value converted to int or float, if it is possible.
+        '''
+        try:
+            return int(value)
+        except:
+            try:
+                return float(value)
+            except:
+                return value
+    
+    @staticmethod
+    def convert_number(value):
+        '''
+        Returns the numeric value converted to int, or to float if it has
+        a fraction or an exponent, or is inf or nan.
+        '''
+        for c in '.eEnN':
+            if c in value:
+                return float(value)
+        return int(value)
+    
+    def detect_types(self, rows):
+        '''
+        Detects the column types from the given rows and the types
+        dictionary. Sets and returns columnTypes: a list of int,
+        convert_number (for columns with float values, ints are kept as ints),
+        float or unicode for every column, or None if the type is unknown
+        and the values should be converted one by one.
+        '''
+        count = len(self.keys or [])
+        if self.raw:
+            self.columnTypes = [unicode] * count
+            return self.columnTypes
+        
+        columnTypes = []
+        for k in xrange(count):
+            kind = None
+            hasFloat = False
+            for value in [r[k] for r in rows if len(r) > k and r[k]]:
+                try:
+                    int(value)
+                    kind = int
+                    continue
+                except ValueError:
+                    pass
+                try:
+                    float(value)
+                    hasFloat = True
+                except ValueError:
+                    kind = unicode
+                    break
+            if hasFloat and not kind is unicode:
+                kind = self.convert_number
+            columnTypes.append(kind)
+        
+        if self.types:
+            for key, kind in self.types.items():
+                idx = self.key_index(key)
+                if idx is None:
+                    raise BaseException('Named value %s not found in data' % (key))
+                if kind is str:
+                    kind = unicode
+                columnTypes[idx] = kind
+        self.columnTypes = columnTypes
+        return columnTypes
+    
+    def convert_rows(self, rows):
+        '''
+        Converts the values of the rows read from the file in place,
+        column by column. Returns the rows.
+        '''
+        if self.columnTypes is None:
+            self.detect_types(rows[:self.sample])
+        convert_value = self.convert_value
+        k = 0
+        for kind in self.columnTypes:
+            if kind is None:
+                for r in rows:
+                    if len(r) > k:
+                        r[k] = convert_value(r[k])
+            elif not kind is unicode:
+                for r in rows:
+                    if len(r) > k and r[k]:
+                        try:
+                            r[k] = kind(r[k])
+                        except ValueError:
+                            r[k] = convert_value(r[k])
+            k += 1
+        if not self.raw:
+            k = len(self.columnTypes)
+            for r in rows:
+                if len(r) > k:
+                    r[k:] = [convert_value(v) for v in r[k:]]
+        return rows
+    
+    def convert(self, row):
+        '''
+        Converts the values of a single row read from the file.
+        Column types should be detected before.
+        '''
+        return self.convert_rows([row])[0]
+    
+    def export_csv(self, filename, encoding='utf-8', delimiter=';', quotechar='"', buffer_size=1048576, **kwargs):
         '''
         Saves the data to CSV file
         
@@ -266,8 +1279,413 @@ class CSVData(Data):
         encoding - CSV table encoding (default: utf-8)
         delimiter - CSV table delimiter (default: ;)
         quotechar - CSV table quotechar (default: ")
+        buffer_size - size of the batches, written to the file, in bytes
+        (default: 1048576)
         '''
         with open(filename, 'wb') as f:
-            csvfile = self.Writer(f, encoding='utf-8', delimiter=';', quotechar='"', **kwargs)
+            csvfile = self.Writer(f, encoding=encoding, delimiter=delimiter, quotechar=quotechar, buffer_size=buffer_size, **kwargs)
             csvfile.writerow(self.keys)
-            csvfile.writerows(self.rows)
+            csvfile.writerows(self.iter_rows())
+
+
+class CSVStreamData(CSVData):
+    '''
+    Class for reading CSV files row by row. Only the keys are read in the
+    constructor. Rows are read from the file when they are iterated, so
+    the table is never held in memory, and the first row is available
+    without reading the whole file.
+    
+    If a file object is given instead of a filename, rows can be iterated
+    only once. Accessing the rows attribute reads all the remaining rows
+    into memory, as in CSVData.
+    '''
+    randomAccess = False
+    
+    def __init__(self, file, encoding='utf-8', delimiter=',', quotechar='"', types=None, sample=100, raw=False, **kwargs):
+        '''
+        Constructor.
+        
+        filename - CSV table filename or an open file
+        encoding - CSV table encoding (default: utf-8)
+        delimiter - CSV table delimiter (default: ,)
+        quotechar - CSV table quotechar (default: ")
+        types, sample, raw - column types, see CSVData
+        '''
+        self.types = types
+        self.sample = sample
+        self.raw = raw
+        self.columnTypes = None
+        self.file = file
+        self.encoding = encoding
+        self.delimiter = delimiter
+        self.quotechar = quotechar
+        self._rows = None
+        self._reader = None
+        
+        if type(file) == str:
+            with open(file) as f:
+                keys = next(self.Reader(f, encoding=encoding, delimiter=delimiter, quotechar=quotechar), None)
+        else:
+            self._reader = self.Reader(file, encoding=encoding, delimiter=delimiter, quotechar=quotechar)
+            keys = next(self._reader, None)
+        self.keys = keys or []
+    
+    def get_rows(self):
+        if self._rows is None:
+            self._rows = list(self.iter_rows())
+        return self._rows
+    
+    def set_rows(self, rows):
+        self._rows = rows
+    
+    rows = property(get_rows, set_rows, doc='List of the rows, read on the first access.')
+    
+    def iter_rows(self):
+        '''
+        Yields the rows, reading them from the file.
+        '''
+        if not self._rows is None:
+            for i in self._rows:
+                yield i
+        elif type(self.file) == str:
+            with open(self.file) as f:
+                csvfile = self.Reader(f, encoding=self.encoding, delimiter=self.delimiter, quotechar=self.quotechar)
+                next(csvfile, None)
+                for i in self.convert_stream(csvfile):
+                    yield i
+        elif not self._reader is None:
+            reader = self._reader
+            self._reader = None
+            for i in self.convert_stream(reader):
+                yield i
+        else:
+            raise BaseException('Rows of %s have already been read' % (self.file))
+    
+    def convert_stream(self, reader):
+        '''
+        Yields the converted rows of the reader. Column types are detected
+        from the first rows on the first reading.
+        '''
+        if self.columnTypes is None:
+            first = []
+            for i in reader:
+                first.append(i)
+                if len(first) >= self.sample:
+                    break
+            for i in self.convert_rows(first):
+                yield i
+        convert = self.convert
+        for i in reader:
+            yield convert(i)
+
+class MappedCSVData(CSVData):
+    '''
+    Class for random access to rows of large CSV files. The file is mapped
+    into memory and only the offsets of the rows are read in the
+    constructor. Rows are decoded when they are accessed, so reading a few
+    rows of a huge table costs almost nothing.
+    
+    The offsets index is saved next to the file (filename.idx) and is
+    rebuilt only if the file has been changed. Only encodings, compatible
+    with ASCII (utf-8, cp1251 etc.), are supported. Rows are read-only.
+    '''
+    randomAccess = False
+    
+    class Rows(object):
+        '''
+        List-like access to the rows of the mapped file.
+        '''
+        def __init__(self, data):
+            self.data = data
+        
+        def __len__(self):
+            return max(0, len(self.data.offsets) - 2)
+        
+        def __getitem__(self, idx):
+            if isinstance(idx, slice):
+                return [self[i] for i in xrange(*idx.indices(len(self)))]
+            count = len(self)
+            if idx < 0:
+                idx += count
+            if idx < 0 or idx >= count:
+                raise IndexError('Row %i not found in data' % (idx))
+            return self.data.read_row(idx)
+        
+        def __iter__(self):
+            read_row = self.data.read_row
+            for i in xrange(len(self)):
+                yield read_row(i)
+    
+    def __init__(self, file, encoding='utf-8', delimiter=',', quotechar='"', types=None, sample=100, raw=False, index=None, **kwargs):
+        '''
+        Constructor.
+        
+        filename - CSV table filename
+        encoding - CSV table encoding (default: utf-8)
+        delimiter - CSV table delimiter (default: ,)
+        quotechar - CSV table quotechar (default: ")
+        types, sample, raw - column types, see CSVData
+        index - filename of the offsets index (default: filename.idx)
+        '''
+        if codecs.lookup(encoding).name.startswith(('utf-16', 'utf-32')):
+            raise BaseException('Encoding %s is not supported for mapped CSV files' % (encoding))
+        self.types = types
+        self.sample = sample
+        self.raw = raw
+        self.columnTypes = None
+        self.file = file
+        self.encoding = encoding
+        self.utf8 = codecs.lookup(encoding).name == 'utf-8'
+        self.delimiter = delimiter
+        self.quotechar = quotechar
+        if index is None:
+            index = file + '.idx'
+        self.indexFile = index
+        
+        self.f = open(file, 'rb')
+        size = getsize(file)
+        if size:
+            self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = ''
+        
+        self.offsets = self.load_index()
+        if self.offsets is None:
+            self.offsets = self.build_index()
+            self.save_index()
+        
+        if len(self.offsets) > 1:
+            self.keys = self.read_record(0)
+        else:
+            self.keys = []
+        self.rows = self.Rows(self)
+        self.detect_types([self.read_record(i) for i in xrange(1, min(len(self.offsets) - 1, self.sample + 1))])
+    
+    def read_record(self, n):
+        '''
+        Returns the n-th record of the file (the header is the record 0)
+        as a list of strings.
+        '''
+        record = self.map[self.offsets[n]:self.offsets[n+1]]
+        if not self.utf8:
+            record = record.decode(self.encoding).encode('utf-8')
+        reader = csv.reader(record.splitlines(True), delimiter=self.delimiter, quotechar=self.quotechar)
+        return [unicode(s, 'utf-8') for s in next(reader, [])]
+    
+    def read_row(self, idx):
+        '''
+        Returns the converted row with given index.
+        '''
+        return self.convert(self.read_record(idx + 1))
+    
+    def build_index(self):
+        '''
+        Finds the offsets of the records in the file. Returns an array of
+        the record start offsets, followed by the size of the file.
+        '''
+        mm = self.map
+        quotechar = self.quotechar
+        size = len(mm)
+        offsets = array(self.offsetType())
+        pos = 0
+        start = 0
+        quoted = False
+        while pos < size:
+            end = mm.find('\n', pos)
+            if end < 0:
+                end = size
+            else:
+                end += 1
+            if quoted or not mm.find(quotechar, pos, end) < 0:
+                quoted = self.line_quoted(mm[pos:end], quoted)
+            if not quoted:
+                offsets.append(start)
+                start = end
+            pos = end
+        if start < size:
+            offsets.append(start)
+        offsets.append(size)
+        return offsets
+    
+    def line_quoted(self, line, quoted):
+        '''
+        Returns True if the line ends inside a quoted field. Quotes are read
+        as csv.reader does: a quote opens a quoted field only at the start
+        of the field, doubled quotes in a quoted field are escaped quotes,
+        other quotes are kept as they are.
+        
+        quoted - True if the line starts inside a quoted field
+        '''
+        quotechar = self.quotechar
+        delimiter = self.delimiter
+        size = len(line)
+        i = 0
+        while i < size:
+            if quoted:
+                q = line.find(quotechar, i)
+                if q < 0:
+                    return True
+                if line[q+1:q+2] == quotechar:
+                    i = q + 2
+                    continue
+                quoted = False
+                i = q + 1
+            elif line[i] == quotechar:
+                quoted = True
+                i += 1
+                continue
+            # the rest of the field is read as is
+            d = line.find(delimiter, i)
+            if d < 0:
+                return False
+            i = d + 1
+        return quoted
+    
+    @staticmethod
+    def offsetType():
+        '''
+        Returns the array type code for the 64-bit offsets.
+        '''
+        if array('L').itemsize >= 8:
+            return 'L'
+        return 'd'
+    
+    def index_stamp(self):
+        '''
+        Returns the line, identifying the source file for the index.
+        '''
+        return 'ATGIDX2 %i %r %s %r %r\n' % (getsize(self.file), getmtime(self.file), self.offsetType(), self.quotechar, self.delimiter)
+    
+    def load_index(self):
+        '''
+        Reads the offsets from the index file. Returns None if there is no
+        index or it was built for another version of the file.
+        '''
+        if not exists(self.indexFile):
+            return None
+        try:
+            with open(self.indexFile, 'rb') as f:
+                if not f.readline() == self.index_stamp():
+                    return None
+                offsets = array(self.offsetType())
+                offsets.fromstring(f.read())
+                return offsets
+        except IOError:
+            return None
+    
+    def save_index(self):
+        '''
+        Writes the offsets to the index file.
+        '''
+        try:
+            with open(self.indexFile, 'wb') as f:
+                f.write(self.index_stamp())
+                self.offsets.tofile(f)
+        except IOError:
+            pass
+    
+    def iter_rows(self):
+        '''
+        Yields the rows, decoding them one by one.
+        '''
+        return iter(self.rows)
+    
+    def close(self):
+        '''
+        Closes the mapped file.
+        '''
+        if not type(self.map) == str:
+            self.map.close()
+        self.f.close()
+
+class SQLiteData(Data):
+    '''
+    Class for reading rows of a SQLite database. Keys are taken from
+    the columns of the query. Rows are read from the cursor in batches when
+    they are iterated, so the table is never held in memory. Accessing
+    the rows attribute reads all the rows into memory.
+    
+    Filtering and ordering of the rows may be done by the database,
+    instead of ATGSKIP in the template:
+    SQLiteData('base.db', table='Items', where='Price > ?', params=(100,), order_by='Name')
+    '''
+    randomAccess = False
+    
+    def __init__(self, database, query=None, table=None, where=None, order_by=None, params=(), batch=1000, **kwargs):
+        '''
+        Constructor.
+        
+        database - database filename or an open sqlite3 connection
+        query - SELECT query to read the rows with
+        table - name of the table to read, if there is no query
+        where - SQL condition to filter the rows with (default: None)
+        order_by - SQL expression to order the rows by (default: None)
+        params - parameters for the placeholders in the query and
+        the condition
+        batch - number of rows, fetched from the cursor at once
+        (default: 1000)
+        '''
+        if isinstance(database, sqlite3.Connection):
+            self.connection = database
+        else:
+            self.connection = sqlite3.connect(database)
+        
+        if query is None:
+            if table is None:
+                raise BaseException('SQLiteData needs a query or a table')
+            query = 'SELECT * FROM "%s"' % (table.replace('"', '""'))
+        # the query is wrapped into subqueries below
+        query = query.rstrip(' \t\r\n;')
+        if where or order_by:
+            query = 'SELECT * FROM (%s)' % (query)
+            if where:
+                query += ' WHERE %s' % (where)
+            if order_by:
+                query += ' ORDER BY %s' % (order_by)
+        self.query = query
+        self.params = tuple(params)
+        self.batch = batch
+        self._rows = None
+        
+        cursor = self.connection.execute('SELECT * FROM (%s) LIMIT 0' % (query), self.params)
+        self.keys = [unicode(c[0]) for c in cursor.description]
+        cursor.close()
+    
+    def get_rows(self):
+        if self._rows is None:
+            self._rows = list(self.iter_rows())
+        return self._rows
+    
+    def set_rows(self, rows):
+        self._rows = rows
+    
+    rows = property(get_rows, set_rows, doc='List of the rows, read on the first access.')
+    
+    def iter_rows(self):
+        '''
+        Yields the rows, reading them from the database. NULL values are
+        replaced with empty strings.
+        '''
+        if not self._rows is None:
+            for i in self._rows:
+                yield i
+            return
+        cursor = self.connection.execute(self.query, self.params)
+        try:
+            while True:
+                rows = cursor.fetchmany(self.batch)
+                if not rows:
+                    break
+                for r in rows:
+                    if None in r:
+                        yield [u'' if v is None else v for v in r]
+                    else:
+                        yield list(r)
+        finally:
+            cursor.close()
+    
+    def close(self):
+        '''
+        Closes the database connection.
+        '''
+        self.connection.close()
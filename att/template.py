@@ -8,17 +8,177 @@ Template module for a Automatic Text Tools.
 License: GPLv3
 '''
 
-import re
+import re, multiprocessing
+from bisect import bisect_left, bisect_right
+from collections import deque
+from data import Data, DataRow
+
+_worker = None
+
+def _init_worker(template, data, masks, skip):
+    '''
+    Initializes the worker process for TemplateV2.iter_shards.
+    '''
+    global _worker
+    ctx = template.new_context(data)
+    ctx.masks = masks
+    ctx.skip = skip
+    _worker = (template, ctx)
+
+def _render_shard(shard, skip=()):
+    '''
+    Renders the rows of the shard in the worker process. Rows with indexes
+    in skip are not rendered.
+    '''
+    template, ctx = _worker
+    start, stop, base, rows = shard
+    ctx.window = RowWindow(base, rows)
+    out = []
+    for i in xrange(start, stop):
+        if i in skip:
+            out.append(template.skipped_row(ctx))
+        else:
+            out.append(template.render_row(ctx, i))
+    return out
+
+class RowWindow(object):
+    '''
+    Rows of the data around the current one. Data is read row by row,
+    so only the rows in the window are available to ATGPREV and ATGNEXT.
+    '''
+    def __init__(self, base=0, rows=(), size=None):
+        '''
+        Constructor.
+        
+        base - index of the first row in the window
+        rows - rows of the window
+        size - maximum number of rows, the oldest rows are dropped
+        '''
+        self.base = base
+        self.rows = deque(rows, size)
+    
+    def append(self, row):
+        '''
+        Adds the next row to the window.
+        '''
+        if len(self.rows) == self.rows.maxlen:
+            self.base += 1
+        self.rows.append(row)
+    
+    def end(self):
+        '''
+        Returns the index after the last row of the window.
+        '''
+        return self.base + len(self.rows)
+    
+    def has_row(self, index):
+        '''
+        Returns True if the row with given index is in the window.
+        '''
+        return self.base <= index < self.base + len(self.rows)
+    
+    def row(self, index):
+        '''
+        Returns the row with given index.
+        '''
+        return self.rows[index - self.base]
+
+class RowFilter(object):
+    '''
+    Selects the rows to generate: rows with the key values from the given
+    set, rows with indexes in the given range or rows, accepted by
+    the given function. Rows, which are not selected, are still read, so
+    ATGPREV and ATGNEXT see all the rows. In the oneFile mode and if
+    the header or the footer of the template can be changed by the rows,
+    all the rows are rendered too, and only the text of the rows, which are
+    not selected, is dropped.
+    '''
+    def __init__(self, select, keyIndex, keys, renderAll=False):
+        '''
+        Constructor.
+        
+        select - set (or list) of key values, xrange or slice of row indexes,
+        or a function, returning True for the DataRow to generate
+        keyIndex - index of the key column
+        keys - dictionary of column indexes by headers
+        renderAll - if True, rows, which are not selected, are rendered too
+        '''
+        self.keyIndex = keyIndex
+        self.keys = keys
+        self.renderAll = renderAll
+        self.function = None
+        self.range = None
+        self.values = None
+        if isinstance(select, (xrange, slice)):
+            if isinstance(select, xrange):
+                select = slice(select[0], select[-1] + 1, (select[1] - select[0]) if len(select) > 1 else 1) if len(select) else slice(0, 0)
+            start, stop, step = select.start or 0, select.stop, select.step or 1
+            if start < 0 or (not stop is None and stop < 0) or step < 1:
+                raise BaseException('Row range should be positive')
+            self.range = (start, stop, step)
+        elif callable(select):
+            self.function = select
+        else:
+            self.values = set([unicode(i) for i in select])
+        self.decisions = {}
+        self.count = 0
+    
+    def accepts(self, index, row):
+        '''
+        Returns True if the row with given index should be generated.
+        '''
+        if not self.range is None:
+            start, stop, step = self.range
+            return start <= index and (stop is None or index < stop) and (index - start) % step == 0
+        elif not self.function is None:
+            return bool(self.function(DataRow(self.keys, row)))
+        return unicode(row[self.keyIndex]) in self.values
+    
+    def feed(self, rows):
+        '''
+        Yields the rows, deciding if they are selected.
+        '''
+        for row in rows:
+            self.decisions[self.count] = self.accepts(self.count, row)
+            self.count += 1
+            yield row
+    
+    def selected(self, index):
+        '''
+        Returns True if the row with given index should be rendered.
+        '''
+        return self.renderAll or self.decisions[index]
+    
+    def wanted(self, index):
+        '''
+        Returns True if the text of the row with given index should be
+        generated. Should be called for every row in order.
+        '''
+        return self.decisions.pop(index)
+
 class Template(object):
     '''
     Empty template class. Generates empty text.
     '''
-    def process(self, data):
+    def process(self, data, workers=1, context=None, select=None):
         '''
         Replace this method in subclasses. 
         '''
         return ''
     
+    def iter_process(self, data, workers=1, context=None, select=None):
+        '''
+        Replace this method in subclasses.
+        Should yield (name, text) pairs instead of returning all of them.
+        '''
+        return iter(())
+    
+    def new_context(self, data):
+        '''
+        Returns a new RenderContext for the given data.
+        '''
+        return RenderContext(data)
+    
     def warning(self, text):
         '''
         Prints a warning
@@ -32,6 +192,93 @@ class Template(object):
         #print 'Template:', text
         pass
     
+class RenderContext(object):
+    '''
+    State of a single rendering of the template: the data, the current row
+    and everything collected from the rows so far. Each process() call
+    has its own context, so one template can render many data at once.
+    '''
+    def __init__(self, data, prefix=u''):
+        '''
+        Constructor.
+        
+        data - an instance of the data.Data class
+        prefix - filename prefix of the template
+        '''
+        self.data = data
+        self.groups = data.groups()
+        self.keys = data.key_map()
+        self.window = RowWindow()
+        self.basePrefix = prefix
+        self.header = u''
+        self.footer = u''
+        self.prefix = prefix
+        self.index = -1
+        self.row = None
+        self.rowPrefix = prefix
+        self.headers = []
+        self.footers = []
+        self.replacement = {}
+        self.masks = {}
+        self.skip = None
+        self.skipHeaders = []
+        self.skipFooters = []
+        # an object with feed(rows) and selected(index) methods,
+        # to render only some of the rows (see ATG)
+        self.selector = None
+        self.element = None
+    
+    def start_row(self, index):
+        '''
+        Resets the row state and moves to the row with given index.
+        '''
+        self.index = index
+        self.row = DataRow(self.keys, self.window.row(index))
+        self.rowPrefix = self.basePrefix
+        self.headers = []
+        self.footers = []
+        self.replacement = {}
+    
+    def value_at(self, key, offset):
+        '''
+        Returns a value for given key from the row with given offset from
+        the current one. The row should be in the window.
+        '''
+        return self.window.row(self.index + offset)[self.keys[key]]
+
+class TemplatePart(object):
+    '''
+    A single command of the compiled ATGv2 template.
+    '''
+    def __init__(self, name, body, raw):
+        '''
+        Constructor.
+        
+        name - command name or column header
+        body - text between the command name and the closing bracket
+        raw - full command text, as written in the template
+        '''
+        self.name = name
+        self.body = body
+        self.raw = raw
+        self.args = ()
+        self.sub = None
+
+class TemplateBlock(object):
+    '''
+    Compiled text of the ATGv2 template. Literal text is stored in chunks,
+    and commands are rendered into the empty slots between them.
+    '''
+    def __init__(self, chunks, slots):
+        '''
+        Constructor.
+        
+        chunks - list of literal text chunks, None for the command slots
+        slots - list of (chunk index, TemplatePart) in the evaluation order
+        '''
+        self.chunks = chunks
+        self.slots = slots
+
 class TemplateV2(Template):
     '''
     Class for reading ATGv2 templates.
@@ -87,7 +334,15 @@ class TemplateV2(Template):
     * [$ATGPREV$Name$], where Name is the column header,
     will be replaced with the with the value of the given header from the
     previous row. ATGSKIP will be used for the first row.
+    [$ATGPREV$Name$N$] will take the value from the N-th previous row,
+    ATGSKIP will be used for the first N rows.
+    * [$ATGNEXT$Name$] and [$ATGNEXT$Name$N$] - same as ATGPREV, but the
+    value is taken from the next (N-th next) row. ATGSKIP will be used
+    for the last rows.
     '''
+    
+    SKIP_TAG = u'[$ATGSKIP_DO$]'
+    CONDITIONS = ('ATGIF', 'ATGIFNOT', 'ATGGREATER', 'ATGLESS')
 
     def __init__(self, filename=None, encoding='utf-8', text=''):
         '''
@@ -127,41 +382,68 @@ class TemplateV2(Template):
             
         self.header = u''
         self.footer = u''
-        self.replacement = {}
-        self._data = None
-        self._multiWords = None
+        self._blocks = {}
+        self.cacheHits = 0
+        self.cacheMisses = 0
         
-        def parse(text):
-            topParts = []
-            matches = {}
-            
-            openers = re.finditer('\[\$.*?\$', text)
-            closers = re.finditer('\$\]', text) 
-            ops = []
-            try:
-                cl = closers.next()
-                while not cl is None:
-                    try:
-                        op = openers.next()
-                        if op.start() < cl.start():
-                            ops.append(op)
-                        else:
-                            idx = -1
-                            try:
-                                while ops[idx].start() > cl.start():
-                                    idx -= 1
-                            except:
-                                raise BaseException('Template parsing error: can not find the opener for '+str(cl.start()))
-                            matches[ops[idx]] = cl
-                            if len(ops) == 1 or idx == -len(ops):
-                                topParts.append(ops[idx])
-                            del ops[idx]
-                            ops.append(op)
-                            try:
-                                cl = closers.next()
-                            except StopIteration:
-                                cl = None
-                    except StopIteration:
+        self.init_commands()
+        self.tree = self.compile(self.text)
+        self.parts = [(p.name, p.body) for s, p in self.tree.slots]
+    
+    def __getstate__(self):
+        '''
+        Returns the template state for pickling, without the bound
+        command handlers.
+        '''
+        state = self.__dict__.copy()
+        del state['commands']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init_commands()
+    
+    def init_commands(self):
+        '''
+        Creates the dictionary of command handlers.
+        '''
+        self.commands = {
+            '_ATGPLAIN': self.cmd_plain,
+            'ATGHEADER': self.cmd_header,
+            'ATGFOOTER': self.cmd_footer,
+            'ATGESCAPE': self.cmd_escape,
+            'ATGLIST': self.cmd_list,
+            'ATGLISTCUT': self.cmd_list_cut,
+            'ATGIF': self.cmd_condition,
+            'ATGIFNOT': self.cmd_condition,
+            'ATGGREATER': self.cmd_condition,
+            'ATGLESS': self.cmd_condition,
+            'ATGREPLACE': self.cmd_replace,
+            'ATGPREFIX': self.cmd_prefix,
+            'ATGSKIP': self.cmd_skip,
+            'ATGPREV': self.cmd_prev,
+            'ATGNEXT': self.cmd_next,
+        }
+    
+    def parse(self, text):
+        '''
+        Finds the top level commands in the given text.
+        Returns the list of (name, body, start, end) tuples, commands first.
+        '''
+        topParts = []
+        matches = {}
+        
+        openers = re.finditer('\[\$.*?\$', text)
+        closers = re.finditer('\$\]', text) 
+        ops = []
+        try:
+            cl = closers.next()
+            while not cl is None:
+                try:
+                    op = openers.next()
+                    if op.start() < cl.start():
+                        ops.append(op)
+                    else:
                         idx = -1
                         try:
                             while ops[idx].start() > cl.start():
@@ -170,320 +452,698 @@ class TemplateV2(Template):
                             raise BaseException('Template parsing error: can not find the opener for '+str(cl.start()))
                         matches[ops[idx]] = cl
                         if len(ops) == 1 or idx == -len(ops):
-                                topParts.append(ops[idx])
+                            topParts.append(ops[idx])
                         del ops[idx]
+                        ops.append(op)
                         try:
                             cl = closers.next()
                         except StopIteration:
                             cl = None
-            except StopIteration:
-                pass
-            parts = []
-            for i in topParts:
-                startPoint = i.end()
-                endPoint = matches[i].start()
-                p = (i.group()[2:-1], text[startPoint:endPoint])
-                if p[0].startswith('ATG'):
-                    parts.insert(0, p)
-                else:
-                    parts.append(p)
-            return parts
-        
-        partCommands = {}
-        
-        def plain(index, flow, keytag):
-            if not keytag in self._data.keys:
-                self.warning('WARNING: keyword not found in table - %s' % (keytag))
-                return flow
-            return flow.replace('[$%s$]' % (keytag), unicode(self._data[keytag, index]))
-        partCommands['_ATGPLAIN'] = plain
-		
-        def nPlain(index, flow, keytag, number):
-            if not keytag+str(number) in self._data.keys:
-                self.warning('WARNING: keyword not found in table - %s' % (keytag+str(number)))
-                return flow
-            return flow.replace('[$%s$]' % (keytag), unicode(self._data[keytag+str(number), index]))
-        
-        def lIndex(index, flow, keytag, number):
-            return flow.replace('[$ATGLINDEX$]', str(number))
-        
-        def addHeader(index, flow, text):
-            if self.header.find(text) < 0:
-                self.header += text
-            key = '[$ATGHEADER$' + text + '$]'
-            return flow.replace(key,'')
-        partCommands['ATGHEADER'] = addHeader
-        
-        def addFooter(index, flow, text):
-            if self.footer.find(text) < 0:
-                self.footer += text
-            key = '[$ATGFOOTER$' + text + '$]'
-            return flow.replace(key,'')
-        partCommands['ATGFOOTER'] = addFooter
+                except StopIteration:
+                    idx = -1
+                    try:
+                        while ops[idx].start() > cl.start():
+                            idx -= 1
+                    except:
+                        raise BaseException('Template parsing error: can not find the opener for '+str(cl.start()))
+                    matches[ops[idx]] = cl
+                    if len(ops) == 1 or idx == -len(ops):
+                            topParts.append(ops[idx])
+                    del ops[idx]
+                    try:
+                        cl = closers.next()
+                    except StopIteration:
+                        cl = None
+        except StopIteration:
+            pass
+        parts = []
+        for i in topParts:
+            startPoint = i.end()
+            endPoint = matches[i].start()
+            p = (i.group()[2:-1], text[startPoint:endPoint], i.start(), matches[i].end())
+            if p[0].startswith('ATG'):
+                parts.insert(0, p)
+            else:
+                parts.append(p)
+        return parts
+    
+    def compile(self, text):
+        '''
+        Compiles the given text into a TemplateBlock, so it can be rendered
+        for every row without parsing and replacing it again.
+        Compiled blocks are cached by their text, the same nested text
+        is parsed only once per template.
+        '''
+        block = self._blocks.get(text)
+        if not block is None:
+            self.cacheHits += 1
+            return block
+        self.cacheMisses += 1
         
-        def addEscape(index, flow, keytag):
-            if not keytag in self._data.keys:
-                self.warning('WARNING: keyword not found in table - %s' % (keytag))
-                return flow
-            string = unicode(self._data[keytag, index])
-            string = string.replace('\n', '\\n')
-            string = string.replace('"', '\\"')
-            string = string.replace('\\', '\\\\')
-            string = string.replace('\'', '\\\'')
-            return flow.replace('[$ATGESCAPE$%s$]' % (keytag), string)
-        partCommands['ATGESCAPE'] = addEscape
-		
-        def addList(index, flow, string):
-            key = '[$ATGLIST$%s$%s$]' % (string.split('$')[0], string[len(string.split('$')[0])+1:])
-            sub = string[len(string.split('$')[0])+1:]
-            keyTag = string.split('$')[0]
-            subparts = parse(sub)
-            myText = u''
-            if not keyTag in self._multiWords:
-                self.warning('Keytag %s is not multiple!' % (keyTag))
-                return flow
-            for j in xrange(1, self._multiWords[keyTag]+1):
-                subText = sub
-                for sp in subparts:
-                    if sp[0] in self._multiWords:
-                        subText = nPlain(index, subText, sp[0], j)
-                    elif sp[0] == 'ATGLINDEX':
-                        subText = lIndex(index, subText, sp[0], j)
-                    elif sp[0] in partCommands:
-                        subText = partCommands[sp[0]](index, subText, sp[1])
-                    elif sp[1] == '':
-                        subText = plain(index, subText, sp[0])
-                    else:
-                        self.warning('Warning: unknown command '+sp[0])
-                if not self._data[keyTag+str(j), index] == u'':
-                    myText += subText
-            return flow.replace(key, myText)
-        partCommands['ATGLIST'] = addList
+        found = self.parse(text)
+        chunks = []
+        positions = {}
+        last = 0
+        for name, body, start, end in sorted(found, key=lambda p: p[2]):
+            if start < last:
+                raise BaseException('Template parsing error: overlapping commands at '+str(start))
+            if start > last:
+                chunks.append(text[last:start])
+            positions[start] = len(chunks)
+            chunks.append(None)
+            last = end
+        if last < len(text):
+            chunks.append(text[last:])
         
-        def addListCut(index, flow, string):
-            key = '[$ATGLISTCUT$%s$%s$]' % (string.split('$')[0], string[len(string.split('$')[0])+1:])
-            sub = string[len(string.split('$')[0])+1:]
-            keyTag = string.split('$')[0]
-            subparts = parse(sub)
-            myText = u''
-            if not keyTag in self._multiWords:
-                self.warning('Keytag %s is not multiple!' % (keyTag))
-                return flow
-            for j in xrange(1, self._multiWords[keyTag]+1):
-                subText = sub
-                for sp in subparts:
-                    if sp[0] in self._multiWords:
-                        subText = nPlain(index, subText, sp[0], j)
-                    elif sp[0] == 'ATGLINDEX':
-                        subText = lIndex(index, subText, sp[0], j)
-                    elif sp[0] in partCommands:
-                        subText = partCommands[sp[0]](index, subText, sp[1])
-                    elif sp[1] == '':
-                        subText = plain(index, subText, sp[0])
-                    else:
-                        self.warning('Warning: unknown command '+sp[0])
-                if not self._data[keyTag+str(j), index] == u'':
-                    myText += subText
-            return flow.replace(key, myText[:-1])
-        partCommands['ATGLISTCUT'] = addListCut
+        slots = []
+        for name, body, start, end in found:
+            slots.append((positions[start], self.compile_part(name, body, text[start:end])))
+        block = TemplateBlock(chunks, slots)
+        self._blocks[text] = block
+        return block
+    
+    def compile_part(self, name, body, raw):
+        '''
+        Returns the TemplatePart for the given command with parsed arguments.
+        '''
+        part = TemplatePart(name, body, raw)
+        words = body.split('$')
+        if name in ('ATGLIST', 'ATGLISTCUT'):
+            part.args = (words[0],)
+            part.sub = self.compile(body[len(words[0])+1:])
+        elif name in self.CONDITIONS:
+            if len(words) < 2:
+                raise BaseException('Template parsing error: %s needs a column and a value' % (name))
+            part.args = (words[0], unicode(words[1]))
+            part.sub = self.compile(body[len(words[0])+len(words[1])+2:])
+        elif name == 'ATGREPLACE':
+            part.args = (words[0], body[len(words[0])+1:])
+        elif name == 'ATGPREFIX':
+            part.sub = self.compile(body)
+        elif name in ('ATGPREV', 'ATGNEXT'):
+            offset = 1
+            if len(words) > 1 and words[1]:
+                try:
+                    offset = int(words[1])
+                except ValueError:
+                    raise BaseException('Template parsing error: bad %s offset %s' % (name, words[1]))
+            part.args = (words[0], offset)
+        elif name == 'ATGESCAPE':
+            part.args = (body,)
+        return part
+    
+    def cache_info(self):
+        '''
+        Returns (hits, misses, size) of the compiled blocks cache.
+        '''
+        return (self.cacheHits, self.cacheMisses, len(self._blocks))
+    
+    def walk(self, block=None, depth=0):
+        '''
+        Yields (part, depth) for every command of the compiled block
+        (the whole template by default), including the nested ones.
+        '''
+        if block is None:
+            block = self.tree
+        for slot, part in block.slots:
+            yield part, depth
+            if not part.sub is None:
+                for i in self.walk(part.sub, depth+1):
+                    yield i
+    
+    def header_is_static(self):
+        '''
+        Returns True if the header is complete after the first row has been
+        generated, i.e. all ATGHEADER commands are at the top level and are
+        processed for every row.
+        '''
+        for part, depth in self.walk():
+            if depth and part.name == 'ATGHEADER':
+                return False
+        return True
+    
+    def footer_is_static(self):
+        '''
+        Returns True if all ATGFOOTER commands are at the top level and are
+        processed for every row.
+        '''
+        for part, depth in self.walk():
+            if depth and part.name == 'ATGFOOTER':
+                return False
+        return True
+    
+    def new_context(self, data):
+        '''
+        Returns a new RenderContext to generate text for the given data.
+        '''
+        if not data.has_key(self.keyField):
+            raise BaseException('Named value %s not found in data' % (self.keyField))
+        ctx = RenderContext(data, self.prefix)
+        for slot, part in self.tree.slots:
+            if part.name == 'ATGHEADER':
+                ctx.skipHeaders.append(part.body)
+            elif part.name == 'ATGFOOTER':
+                ctx.skipFooters.append(part.body)
+        if data.randomAccess:
+            ctx.masks = self.condition_masks(data)
+            ctx.skip = self.skip_mask(ctx, len(data.rows))
+        return ctx
+    
+    @staticmethod
+    def evaluate(name, target, value):
+        '''
+        Returns the result of the condition command for the given value:
+        1 if it is true, 0 if it is false, 2 if the values are uncomparable.
+        '''
+        if name == 'ATGIF':
+            return int(unicode(value) == target)
+        elif name == 'ATGIFNOT':
+            return int(not unicode(value) == target)
+        try:
+            if name == 'ATGGREATER':
+                return int(float(value) > float(target))
+            return int(float(value) < float(target))
+        except:
+            return 2
+    
+    def condition_masks(self, data):
+        '''
+        Evaluates all the condition commands of the template for every row
+        of the data at once. Returns a dictionary of bytearrays with
+        the results of evaluate() by rows, by (name, column, value).
+        Rows, that are too short, are marked with 3 and are evaluated
+        while rendering.
+        Equality is evaluated by grouping the rows by their values,
+        comparisons - by the sorted index of the numeric values.
+        '''
+        columns = {}
+        for part, depth in self.walk():
+            if part.name in self.CONDITIONS and data.has_key(part.args[0]):
+                columns.setdefault(part.args[0], set()).add((part.name, part.args[1]))
         
-        def addIf(index, flow, string):
-            key = '[$ATGIF$%s$%s$]' % (string.split('$')[0], string[len(string.split('$')[0])+1:])
-            sub = string[len(string.split('$')[0])+len(string.split('$')[1])+2:]
-            keyTag = string.split('$')[0]
-            targetValue = string.split('$')[1]
-            subparts = parse(sub)
-            myText = u''
-            if self._data[keyTag, 0] == []:
-                self.warning('WARNING: keyword not found in table - %s' % (keyTag))
-                return flow
-            if unicode(self._data[keyTag, index]) == unicode(targetValue):
-                subText = sub
-                for sp in subparts:
-                    if sp[0] in partCommands:
-                        subText = partCommands[sp[0]](index, subText, sp[1])
-                    elif sp[1] == '':
-                        subText = plain(index, subText, sp[0])
+        masks = {}
+        for key, conditions in columns.items():
+            idx = data.key_index(key)
+            column = [r[idx] if len(r) > idx else None for r in data.iter_rows()]
+            count = len(column)
+            short = [i for i in xrange(count) if column[i] is None]
+            
+            groups = None
+            numbers = None
+            for name, target in conditions:
+                if name in ('ATGIF', 'ATGIFNOT'):
+                    if groups is None:
+                        groups = {}
+                        for i in xrange(count):
+                            if not column[i] is None:
+                                groups.setdefault(unicode(column[i]), []).append(i)
+                    if name == 'ATGIF':
+                        mask = bytearray(count)
+                        state = 1
                     else:
-                        self.warning('Warning: unknown command '+sp[0])
-                myText += subText        
-            return flow.replace(key, myText)
-        partCommands['ATGIF'] = addIf
-    
-        def addIfNot(index, flow, string):
-            key = '[$ATGIFNOT$%s$%s$]' % (string.split('$')[0], string[len(string.split('$')[0])+1:])
-            sub = string[len(string.split('$')[0])+len(string.split('$')[1])+2:]
-            keyTag = string.split('$')[0]
-            targetValue = string.split('$')[1]
-            subparts = parse(sub)
-            myText = u''
-            if self._data[keyTag, 0] == []:
-                self.warning('WARNING: keyword not found in table - %s' % (keyTag))
-                return flow
-            if not unicode(self._data[keyTag, index]) == unicode(targetValue):
-                subText = sub
-                for sp in subparts:
-                    if sp[0] in partCommands:
-                        subText = partCommands[sp[0]](index, subText, sp[1])
-                    elif sp[1] == '':
-                        subText = plain(index, subText, sp[0])
+                        mask = bytearray('\x01') * count
+                        state = 0
+                    for i in groups.get(target, ()):
+                        mask[i] = state
+                    for i in short:
+                        mask[i] = 3
+                else:
+                    if numbers is None:
+                        numbers = []
+                        bad = short[:]
+                        for i in xrange(count):
+                            try:
+                                value = float(column[i])
+                            except:
+                                if not column[i] is None:
+                                    bad.append(i)
+                                continue
+                            if value == value:
+                                numbers.append((value, i))
+                        numbers.sort()
+                        points = [v for v, i in numbers]
+                    try:
+                        value = float(target)
+                    except:
+                        masks[(name, key, target)] = bytearray('\x02') * count
+                        continue
+                    mask = bytearray(count)
+                    if not value == value:
+                        hits = ()
+                    elif name == 'ATGGREATER':
+                        hits = numbers[bisect_right(points, value):]
                     else:
-                        self.warning('Warning: unknown command '+sp[0])
-                myText += subText
-            return flow.replace(key, myText)
-        partCommands['ATGIFNOT'] = addIfNot
-        
-        def addGreater(index, flow, string):
-            key = '[$ATGGREATER$%s$%s$]' % (string.split('$')[0], string[len(string.split('$')[0])+1:])
-            sub = string[len(string.split('$')[0])+len(string.split('$')[1])+2:]
-            keyTag = string.split('$')[0]
-            targetValue = string.split('$')[1]
-            subparts = parse(sub)
-            myText = u''
-            if self._data[keyTag, 0] == []:
-                self.warning('WARNING: keyword not found in table - %s' % (keyTag))
-                return flow
-            try:
-                if float(self._data[keyTag, index]) > float(targetValue):
-                    subText = sub
-                    for sp in subparts:
-                        if sp[0] in partCommands:
-                            subText = partCommands[sp[0]](index, subText, sp[1])
-                        elif sp[1] == '':
-                            subText = plain(index, subText, sp[0])
-                        else:
-                            self.warning('Warning: unknown command '+sp[0])
-                    myText += subText
-            except:
-                self.warning('ERROR: trying to compare uncomparable values!')
-            return flow.replace(key, myText)
-        partCommands['ATGGREATER'] = addGreater
+                        hits = numbers[:bisect_left(points, value)]
+                    for v, i in hits:
+                        mask[i] = 1
+                    for i in bad:
+                        mask[i] = 2
+                masks[(name, key, target)] = mask
+        return masks
+    
+    def skip_paths(self, block):
+        '''
+        Returns the lists of the condition commands, which skip the row
+        for sure if all of them are true, i.e. lead to ATGSKIP directly.
+        '''
+        paths = []
+        for slot, part in block.slots:
+            if part.name == 'ATGSKIP':
+                paths.append(())
+            elif part.name in self.CONDITIONS:
+                for p in self.skip_paths(part.sub):
+                    paths.append((part,) + p)
+        return paths
+    
+    def skip_mask(self, ctx, count):
+        '''
+        Returns a bytearray with 1 for every row, that will be skipped for
+        sure and may be dropped before rendering, or None if no row can
+        be dropped. Rows are never dropped if the template has ATGREPLACE
+        commands (they may change the skip tag) or nested ATGHEADER and
+        ATGFOOTER commands (a dropped row has to produce the same headers
+        and footers as the others). The last row is always rendered, as its
+        prefix is used for the single file name, and rows, shorter than
+        the keys, are always rendered too.
+        '''
+        for part, depth in self.walk():
+            if part.name == 'ATGREPLACE' or (depth and part.name in ('ATGHEADER', 'ATGFOOTER')):
+                return None
+        skip = None
+        for path in self.skip_paths(self.tree):
+            masks = [ctx.masks.get((p.name,) + p.args) for p in path]
+            if None in masks:
+                continue
+            if skip is None:
+                skip = bytearray(count)
+            for i in xrange(count):
+                for m in masks:
+                    if not m[i] == 1:
+                        break
+                else:
+                    skip[i] = 1
+        if skip:
+            # short rows may fail while rendering, so they are not dropped
+            width = len(ctx.data.keys)
+            i = 0
+            for r in ctx.data.iter_rows():
+                if len(r) < width:
+                    skip[i] = 0
+                i += 1
+            skip[count-1] = 0
+        return skip
+    
+    def render(self, block, ctx, number=None):
+        '''
+        Returns the text of the compiled block for the current row
+        of the context.
         
-        def addLess(index, flow, string):
-            key = '[$ATGLESS$%s$%s$]' % (string.split('$')[0], string[len(string.split('$')[0])+1:])
-            sub = string[len(string.split('$')[0])+len(string.split('$')[1])+2:]
-            keyTag = string.split('$')[0]
-            targetValue = string.split('$')[1]
-            subparts = parse(sub)
-            myText = u''
-            if self._data[keyTag, 0] == []:
-                self.warning('WARNING: keyword not found in table - %s' % (keyTag))
-                return flow
+        number - column number, if the block is the ATGLIST text.
+        '''
+        pieces = list(block.chunks)
+        for slot, part in block.slots:
+            pieces[slot] = self.render_part(part, ctx, number)
+        return u''.join(pieces)
+    
+    def render_part(self, part, ctx, number=None):
+        '''
+        Returns the text of the single command for the current row.
+        '''
+        name = part.name
+        if not number is None:
+            if name in ctx.groups:
+                return self.cmd_nplain(ctx, part, number)
+            elif name == 'ATGLINDEX':
+                return unicode(number)
+        if name in self.commands:
+            return self.commands[name](ctx, part)
+        elif part.body == u'':
+            return self.cmd_plain(ctx, part)
+        self.warning('Warning: unknown command '+name)
+        return part.raw
+    
+    def cmd_plain(self, ctx, part):
+        keytag = part.name
+        if not keytag in ctx.row:
+            self.warning('WARNING: keyword not found in table - %s' % (keytag))
+            return part.raw
+        return unicode(ctx.row[keytag])
+    
+    def cmd_nplain(self, ctx, part, number):
+        positions = ctx.groups[part.name]
+        if number <= len(positions):
+            idx = positions[number-1]
+        else:
+            idx = ctx.data.key_index(part.name + str(number))
+        if idx is None:
+            self.warning('WARNING: keyword not found in table - %s' % (part.name + str(number)))
+            return part.raw
+        return unicode(ctx.row.values[idx])
+    
+    def cmd_header(self, ctx, part):
+        ctx.headers.append(part.body)
+        return u''
+    
+    def cmd_footer(self, ctx, part):
+        ctx.footers.append(part.body)
+        return u''
+    
+    def cmd_escape(self, ctx, part):
+        keytag = part.args[0]
+        if not keytag in ctx.row:
+            self.warning('WARNING: keyword not found in table - %s' % (keytag))
+            return part.raw
+        string = unicode(ctx.row[keytag])
+        string = string.replace('\n', '\\n')
+        string = string.replace('"', '\\"')
+        string = string.replace('\\', '\\\\')
+        string = string.replace('\'', '\\\'')
+        return string
+    
+    def list_text(self, ctx, part):
+        '''
+        Returns the ATGLIST text for the current row or None, if the column
+        is not multiple.
+        '''
+        keyTag = part.args[0]
+        if not keyTag in ctx.groups:
+            self.warning('Keytag %s is not multiple!' % (keyTag))
+            return None
+        myText = []
+        values = ctx.row.values
+        j = 0
+        for idx in ctx.groups[keyTag]:
+            j += 1
+            subText = self.render(part.sub, ctx, j)
+            if idx is None:
+                raise BaseException('Named value %s not found in data' % (keyTag+str(j)))
+            if not values[idx] == u'':
+                myText.append(subText)
+        return u''.join(myText)
+    
+    def cmd_list(self, ctx, part):
+        text = self.list_text(ctx, part)
+        if text is None:
+            return part.raw
+        return text
+    
+    def cmd_list_cut(self, ctx, part):
+        text = self.list_text(ctx, part)
+        if text is None:
+            return part.raw
+        return text[:-1]
+    
+    def check(self, ctx, part):
+        '''
+        Returns the result of the condition command for the current row
+        (see evaluate) or None if the column is not found.
+        '''
+        mask = ctx.masks.get((part.name,) + part.args)
+        if not mask is None:
+            state = mask[ctx.index]
+            if state < 3:
+                return state
+        keyTag, targetValue = part.args
+        if not ctx.data.has_key(keyTag):
+            self.warning('WARNING: keyword not found in table - %s' % (keyTag))
+            return None
+        if part.name in ('ATGGREATER', 'ATGLESS'):
             try:
-                if float(self._data[keyTag, index]) < float(targetValue):
-                    subText = sub
-                    for sp in subparts:
-                        if sp[0] in partCommands:
-                            subText = partCommands[sp[0]](index, subText, sp[1])
-                        elif sp[1] == '':
-                            subText = plain(index, subText, sp[0])
-                        else:
-                            self.warning('Warning: unknown command '+sp[0])
-                    myText += subText
+                value = ctx.row[keyTag]
             except:
-                self.warning('ERROR: trying to compare uncomparable values!')
-            return flow.replace(key, myText)
-        partCommands['ATGLESS'] = addLess
-        
-        def addReplace(index, flow, string):
-            key = '[$ATGREPLACE$%s$%s$]' % (string.split('$')[0], string[len(string.split('$')[0])+1:])
-            targetString = string[len(string.split('$')[0])+1:]
-            srcString = string.split('$')[0]
-            self.replacement[srcString] = targetString
-            key = '[$ATGREPLACE$' + string + '$]'
-            return flow.replace(key,'')
-        partCommands['ATGREPLACE'] = addReplace
-        
-        def addPrefix(index, flow, string):
-            key = '[$ATGPREFIX$%s$%s$]' % (string.split('$')[0], string[len(string.split('$')[0])+1:])
-            sub = string
-            subparts = parse(sub)
-            for sp in subparts:
-                if sp[0] in partCommands:
-                    sub = partCommands[sp[0]](index, sub, sp[1])
-                elif sp[1] == '':
-                    sub = plain(index, sub, sp[0])
-                else:
-                    self.warning('Warning: unknown command '+sp[0])
-            self.bonusPrefix += sub
-            key = '[$ATGPREFIX$' + string + '$]'
-            return flow.replace(key,'')
-        partCommands['ATGPREFIX'] = addPrefix
-        
-        def skip(index, flow, string):
-            return u'[$ATGSKIP_DO$]'
-        partCommands['ATGSKIP'] = skip
+                return 2
+        else:
+            value = ctx.row[keyTag]
+        return self.evaluate(part.name, targetValue, value)
+    
+    def cmd_condition(self, ctx, part):
+        state = self.check(ctx, part)
+        if state is None:
+            return part.raw
+        elif state == 2:
+            self.warning('ERROR: trying to compare uncomparable values!')
+        elif state:
+            return self.render(part.sub, ctx)
+        return u''
+    
+    def cmd_replace(self, ctx, part):
+        ctx.replacement[part.args[0]] = part.args[1]
+        return u''
+    
+    def cmd_prefix(self, ctx, part):
+        ctx.rowPrefix += self.render(part.sub, ctx)
+        return u''
+    
+    def cmd_skip(self, ctx, part):
+        return self.SKIP_TAG
+    
+    def cmd_prev(self, ctx, part):
+        keytag, offset = part.args
+        if not ctx.data.has_key(keytag):
+            self.warning('WARNING: keyword not found in table - %s' % (keytag))
+            return part.raw
+        if ctx.index < offset:
+            self.log('INFORMATION: Skipping ATGPREV tag for entry with index = %i' % (ctx.index))
+            return self.SKIP_TAG
+        return unicode(ctx.value_at(keytag, -offset))
+    
+    def cmd_next(self, ctx, part):
+        keytag, offset = part.args
+        if not ctx.data.has_key(keytag):
+            self.warning('WARNING: keyword not found in table - %s' % (keytag))
+            return part.raw
+        if not ctx.window.has_row(ctx.index + offset):
+            self.log('INFORMATION: Skipping ATGNEXT tag for entry with index = %i' % (ctx.index))
+            return self.SKIP_TAG
+        return unicode(ctx.value_at(keytag, offset))
+    
+    def render_row(self, ctx, index):
+        '''
+        Generates text for a single row of the context data.
+        Returns (prefix, element, text, headers, footers), where element is
+        the row's key value, text is None if the row was skipped, headers
+        and footers are the texts of ATGHEADER and ATGFOOTER commands,
+        found in this row.
+        '''
+        if ctx.skip and ctx.skip[index]:
+            self.log('ATGSKIP Tag found. Skipping row %i.' % (index))
+            return self.skipped_row(ctx)
+        ctx.start_row(index)
+        element = ctx.row[self.keyField]
+        text = self.render(self.tree, ctx)
+        for i in ctx.replacement:
+            text = text.replace(i, ctx.replacement[i])
         
-        def prev(index, flow, string):
-            key = '[$ATGPREV$%s$]' % (string.split('$')[0])
-            keytag = string.split('$')[0]
-            if self._data[keytag, 0] == []:
-                self.warning('WARNING: keyword not found in table - %s' % (keytag))
-                return flow
-            if index == 0:
-                self.log('INFORMATION: Skipping ATGPREV tag for entry with index = 0')
-                return u'[$ATGSKIP_DO$]'
-            return flow.replace('[$ATGPREV$%s$]' % (keytag), unicode(self._data.col_by_key(keytag)[index-1]))
-        partCommands['ATGPREV'] = prev
+        if self.SKIP_TAG in text:
+            self.log('ATGSKIP Tag found. Skipping ' + unicode(element) + '.')
+            text = None
+        else:
+            self.log('Created %s' % (element))
+        return ctx.rowPrefix, element, text, ctx.headers, ctx.footers
+    
+    def skipped_row(self, ctx):
+        '''
+        Returns the result of render_row for a row, that is not rendered:
+        without text and with the top level headers and footers only.
+        '''
+        return ctx.basePrefix, None, None, ctx.skipHeaders, ctx.skipFooters
+    
+    def select_row(self, ctx, index):
+        '''
+        Renders the row, unless the selector of the context skips it.
+        '''
+        if not ctx.selector is None and not ctx.selector.selected(index):
+            return self.skipped_row(ctx)
+        return self.render_row(ctx, index)
+    
+    def collect(self, ctx, row):
+        '''
+        Adds the headers and footers of the row, returned by render_row,
+        to the context ones. Returns (name, text) for the row
+        or None if the row was skipped.
+        '''
+        prefix, element, text, headers, footers = row
+        for i in headers:
+            if ctx.header.find(i) < 0:
+                ctx.header += i
+        for i in footers:
+            if ctx.footer.find(i) < 0:
+                ctx.footer += i
+        ctx.prefix = prefix
+        ctx.element = element
         
-        self.commands = partCommands
-        self.parts = parse(self.text)
+        if text is None:
+            return None
+        name = prefix + unicode(element)
+        if self.oneFile:
+            return name, text
+        return name, ctx.header + text + ctx.footer
     
-    def process(self, data):
+    def window_size(self):
         '''
-        Generate text for the given data.
+        Returns (behind, ahead) - the number of rows before and after
+        the current one, used by ATGPREV and ATGNEXT.
+        '''
+        behind = 0
+        ahead = 0
+        for part, depth in self.walk():
+            if part.name == 'ATGPREV':
+                behind = max(behind, part.args[1])
+            elif part.name == 'ATGNEXT':
+                ahead = max(ahead, part.args[1])
+        return behind, ahead
+    
+    def iter_rows(self, ctx):
+        '''
+        Renders rows of the context data, reading them in a single pass.
+        Yields the results of render_row in the original order.
+        '''
+        behind, ahead = self.window_size()
+        window = ctx.window = RowWindow(0, (), behind + ahead + 1)
+        index = 0
+        rows = ctx.data.iter_rows()
+        if not ctx.selector is None:
+            rows = ctx.selector.feed(rows)
+        for row in rows:
+            window.append(row)
+            if window.end() > index + ahead:
+                yield self.select_row(ctx, index)
+                index += 1
+        while index < window.end():
+            yield self.select_row(ctx, index)
+            index += 1
+    
+    def split_rows(self, rows, size):
+        '''
+        Splits the rows into shards for iter_shards. Yields
+        (start, stop, base, rows) tuples, where start and stop are the
+        indexes of the rows to render, and rows are the rows from the base
+        index, including ones needed by ATGPREV and ATGNEXT.
+        '''
+        behind, ahead = self.window_size()
+        buf = []
+        base = 0
+        start = 0
+        for row in rows:
+            buf.append(row)
+            if base + len(buf) >= start + size + ahead:
+                stop = start + size
+                yield start, stop, base, list(buf)
+                cut = stop - behind
+                if cut > base:
+                    del buf[:cut - base]
+                    base = cut
+                start = stop
+        while start < base + len(buf):
+            stop = min(start + size, base + len(buf))
+            yield start, stop, base, list(buf)
+            cut = stop - behind
+            if cut > base:
+                del buf[:cut - base]
+                base = cut
+            start = stop
+    
+    def iter_shards(self, data, workers, size=1000, context=None):
         '''
-        self._data = data
+        Renders rows of the data in a pool of worker processes.
+        Yields the results of render_row in the original order.
         
-        multiWords = {}
-        numbs = ('1','2','3','4','5','6','7','8','9','0')
+        workers - number of worker processes
+        size - number of rows, rendered by a worker at once
+        context - RenderContext from new_context(data), a new one is
+        created if None
+        '''
+        ctx = context
+        if ctx is None:
+            ctx = self.new_context(data)
+        keys = Data()
+        keys.keys = list(data.keys)
+        pool = multiprocessing.Pool(workers, _init_worker, (self, keys, ctx.masks, ctx.skip))
+        try:
+            pending = deque()
+            rows = data.iter_rows()
+            selector = ctx.selector
+            if not selector is None:
+                rows = selector.feed(rows)
+            for shard in self.split_rows(rows, size):
+                if len(pending) >= workers * 2:
+                    for row in pending.popleft().get():
+                        yield row
+                skip = ()
+                if not selector is None:
+                    skip = set([i for i in xrange(shard[0], shard[1]) if not selector.selected(i)])
+                pending.append(pool.apply_async(_render_shard, (shard, skip)))
+            while pending:
+                for row in pending.popleft().get():
+                    yield row
+        finally:
+            pool.terminate()
+            pool.join()
+    
+    def iter_process(self, data, workers=1, context=None, select=None):
+        '''
+        Generates text for the given data one row at a time.
+        Yields (name, text) pairs for every row, that was not skipped.
+        Rows are read from data.iter_rows() in a single pass, so the data
+        may be a stream (i.e. CSVStreamData).
         
-        for i in data.keys:
-            multi = False
-            while i[-1] in numbs:
-                i = i[:-1]
-                multi = True
-            if multi:
-                if i in multiWords:
-                    multiWords[i] += 1
-                else:
-                    multiWords[i] = 1
-        self._multiWords = multiWords
+        In the oneFile mode text contains only the row text, the header and
+        the footer are available in the context (and in self.header and
+        self.footer) after the last row has been generated.
         
-        if self.oneFile:
-            out = ''
+        workers - number of processes to render rows in. Output is the same
+        as with a single process.
+        context - RenderContext from new_context(data). All the rendering
+        state is kept there, so the template can be used by several threads
+        at once. A new context is created if None.
+        select - set of key values, xrange or slice of row indexes, or
+        a function, returning True for the DataRow to generate (see RowFilter).
+        All the rows are generated if None. ATGPREV, ATGNEXT, the header and
+        the footer are the same, as if all the rows were generated.
+        '''
+        ctx = context
+        if ctx is None:
+            ctx = self.new_context(data)
+        rowFilter = None
+        if not select is None:
+            renderAll = self.oneFile or not (self.header_is_static() and self.footer_is_static())
+            rowFilter = ctx.selector = RowFilter(select, ctx.keys[self.keyField], ctx.keys, renderAll)
+        if workers > 1:
+            rows = self.iter_shards(data, workers, context=ctx)
         else:
-            out = {} 
+            rows = self.iter_rows(ctx)
         index = 0
-        partCommands = self.commands
-        for element in data.col_by_key(self.keyField):
-            self.bonusPrefix = self.prefix
-            text = self.text
-            for i in self.parts:
-                if i[0] in partCommands:
-                    text = partCommands[i[0]](index, text, i[1])
-                elif i[1] == u'':
-                    text = partCommands['_ATGPLAIN'](index, text, i[0])
-                else:
-                    self.warning('Warning: unknown command '+i[0])
-            for i in self.replacement:
-                text = text.replace(i, self.replacement[i])
-            self.replacement = {}
+        for row in rows:
+            out = self.collect(ctx, row)
+            if not rowFilter is None and not rowFilter.wanted(index):
+                out = None
             index += 1
-            
-            if u'[$ATGSKIP_DO$]' in text:
-                self.log('ATGSKIP Tag found. Skipping ' + unicode(element) + '.')
-            else:
-                if self.oneFile:
-                    out += text
-                else:
-                    name = self.bonusPrefix + unicode(element)
-                    out[name] = self.header + text + self.footer
-                self.log('Created %s' % (element))
+            if not out is None:
+                yield out
+        self.header = ctx.header
+        self.footer = ctx.footer
+        self.bonusPrefix = ctx.prefix
+    
+    def process(self, data, workers=1, context=None, select=None):
+        '''
+        Generate text for the given data.
+        Returns a dictionary of texts by file names, or a single text
+        in the oneFile mode.
         
+        workers - number of processes to render rows in.
+        context - RenderContext from new_context(data), see iter_process.
+        select - rows to generate, see iter_process.
+        '''
+        ctx = context
+        if ctx is None:
+            ctx = self.new_context(data)
         if self.oneFile:
-            out = self.header + out + self.footer
+            out = [text for name, text in self.iter_process(data, workers, ctx, select)]
+            return ctx.header + u''.join(out) + ctx.footer
         
+        out = {}
+        for name, text in self.iter_process(data, workers, ctx, select):
+            out[name] = text
         return out
     
     @staticmethod
@@ -494,4 +1154,6 @@ class TemplateV2(Template):
         obj.extension = kwargs.get('extension', '')
         obj.prefix = kwargs.get('prefix', '')
         obj.encoding = kwargs.get('encoding', 'utf-8')
+        obj.tree = obj.compile(text)
+        obj.parts = [(p.name, p.body) for s, p in obj.tree.slots]
         return obj
\ No newline at end of file
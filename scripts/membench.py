@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Memory benchmark for the compact row storage of CSVData.
+
+Generates a CSV table with repeated text values, loads it with and without
+the compact storage and prints the size of the rows and the time of loading
+and iteration.
+
+Usage: membench.py [rows]
+
+(c) 2013 Ivan "Kai SD" Korystin
+
+License: GPLv3
+'''
+
+import sys, os, tempfile, time, random
+from array import array
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from att.data import CSVData, CompactRows
+
+def deep_size(obj, seen=None):
+    '''
+    Returns the size of the object and all objects, referenced by it, in bytes.
+    '''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum([deep_size(i, seen) for i in obj])
+    elif isinstance(obj, dict):
+        size += sum([deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items()])
+    elif isinstance(obj, CompactRows):
+        size += deep_size(obj.__dict__, seen)
+    return size
+
+def make_table(filename, count):
+    '''
+    Writes a table with the given number of rows.
+    '''
+    random.seed(0)
+    categories = [u'Категория %i' % i for i in xrange(50)]
+    brands = [u'Brand %i' % i for i in xrange(300)]
+    units = [u'pcs', u'kg', u'm', u'l']
+    with open(filename, 'wb') as f:
+        f.write('Id,Name,Category,Brand,Unit,Price,Stock\n')
+        for i in xrange(count):
+            row = [unicode(i), u'Item %i' % i, random.choice(categories), random.choice(brands),
+                   random.choice(units), u'%.2f' % (random.random() * 1000), unicode(random.randint(0, 500))]
+            f.write(u','.join(row).encode('utf-8') + '\n')
+
+def measure(filename, compact):
+    start = time.time()
+    data = CSVData(filename, compact=compact)
+    loaded = time.time() - start
+    start = time.time()
+    for r in data.iter_rows():
+        pass
+    iterated = time.time() - start
+    return deep_size(data.rows), loaded, iterated
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    fd, filename = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+    try:
+        make_table(filename, count)
+        print '%i rows, %.1f MB file' % (count, os.path.getsize(filename) / 1048576.0)
+        results = {}
+        for compact in (False, True):
+            size, loaded, iterated = measure(filename, compact)
+            results[compact] = size
+            print '%-8s rows: %7.1f MB  load: %.2fs  iteration: %.2fs' % (
+                'compact' if compact else 'lists', size / 1048576.0, loaded, iterated)
+        print 'reduction: %.1fx' % (float(results[False]) / results[True])
+    finally:
+        os.remove(filename)
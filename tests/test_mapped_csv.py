@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the record offsets of MappedCSVData.
+
+Run: python -m unittest discover tests
+'''
+import os, sys, tempfile, unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from att.data import CSVData, MappedCSVData
+
+class MappedCSVDataTest(unittest.TestCase):
+    def read(self, text, **kwargs):
+        '''
+        Returns the rows of the text, read by CSVData and MappedCSVData.
+        '''
+        handle, filename = tempfile.mkstemp(suffix='.csv')
+        os.write(handle, text)
+        os.close(handle)
+        try:
+            data = MappedCSVData(filename, **kwargs)
+            mapped = list(data.rows)
+            data.map.close()
+            data.f.close()
+            return CSVData(filename, **kwargs).rows, mapped
+        finally:
+            os.remove(filename)
+            if os.path.exists(filename + '.idx'):
+                os.remove(filename + '.idx')
+
+    def test_quote_inside_field(self):
+        rows, mapped = self.read('Id,Size\n1,5" screen\n2,x\n3,y\n')
+        self.assertEqual(len(mapped), 3)
+        self.assertEqual(mapped, rows)
+
+    def test_escaped_quotes(self):
+        rows, mapped = self.read('Id,Note\n1,"say ""hi""\nthere"\n2,""""\n3,"a"b,c\n')
+        self.assertEqual(len(mapped), 3)
+        self.assertEqual(mapped, rows)
+        self.assertEqual(mapped[0][1], u'say "hi"\nthere')
+
+    def test_delimiter(self):
+        rows, mapped = self.read('Id;Note\n1;"a;b\n""c"\n2;x"y\n', delimiter=';')
+        self.assertEqual(len(mapped), 2)
+        self.assertEqual(mapped, rows)
+
+if __name__ == '__main__':
+    unittest.main()